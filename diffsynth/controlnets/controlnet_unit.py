@@ -1,7 +1,24 @@
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
 import numpy as np
 import torch
 
-from .processors import Processor_id
+from .processors import Processor_id, cpu_processor_ids, annotate_file
+from ..data.video import load_frame
+
+
+def ordered_map(executor, fn, items, max_pending):
+    # Like executor.map, but at most max_pending items are in flight, so results never pile up in memory.
+    futures = deque()
+    for item in items:
+        futures.append(executor.submit(fn, item))
+        if len(futures) >= max_pending:
+            yield futures.popleft().result()
+    while len(futures) > 0:
+        yield futures.popleft().result()
 
 
 class ControlNetConfigUnit:
@@ -12,10 +29,11 @@ class ControlNetConfigUnit:
 
 
 class ControlNetUnit:
-    def __init__(self, processor, model, scale=1.0):
+    def __init__(self, processor, model, scale=1.0, model_path=None):
         self.processor = processor
         self.model = model
         self.scale = scale
+        self.model_path = model_path
 
 
 class MultiControlNetManager:
@@ -23,28 +41,61 @@ class MultiControlNetManager:
         self.processors = [unit.processor for unit in controlnet_units]
         self.models = [unit.model for unit in controlnet_units]
         self.scales = [unit.scale for unit in controlnet_units]
+        self.model_paths = [unit.model_path for unit in controlnet_units]
 
     def process_image(self, image, processor_id=None):
         if processor_id is None:
             processed_image = [processor(image) for processor in self.processors]
         else:
             processed_image = [self.processors[processor_id](image)]
-        processed_image = torch.concat([
-            torch.Tensor(np.array(image_, dtype=np.float32) / 255).permute(2, 0, 1).unsqueeze(0)
-            for image_ in processed_image
-        ], dim=0)
+        processed_image = torch.concat([self.image_to_tensor(image_) for image_ in processed_image], dim=0)
         return processed_image
 
+    def image_to_tensor(self, image):
+        return torch.Tensor(np.array(image, dtype=np.float32) / 255).permute(2, 0, 1).unsqueeze(0)
+
+    def process_images(self, images, processor_id, num_workers=0, load_fn=None):
+        # Annotates a sequence of frame files, yields (1, 3, height, width) tensors in the same order.
+        # CPU annotators run in num_workers processes. The others (GPU annotators, tile) run here, while num_workers threads read the next frames.
+        # The controlnet_aux detectors take one PIL image per call (their pre- and postprocessing too), so the GPU annotators
+        # are not batched, only the frame reads overlap with them. The ControlNet embeddings are batched, see build_controlnet_store.
+        # The processes are spawned, not forked: the parent has CUDA initialized and background writer threads running.
+        # With the spawn start method the main script is imported again by every worker, it needs an if __name__ == "__main__" guard.
+        # load_fn(path) returns the PIL image of a frame, it is used instead of reading the file in the annotator.
+        annotator = self.processors[processor_id]
+        if num_workers <= 0:
+            for image in images:
+                yield self.process_image(image if load_fn is None else load_fn(image), processor_id=processor_id)
+        elif annotator.processor_id in cpu_processor_ids:
+            # The workers read the frame files themselves, they must exist on disk.
+            fn = partial(annotate_file, annotator.processor_id, annotator.detect_resolution)
+            with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+                for image in ordered_map(executor, fn, images, max_pending=num_workers * 4):
+                    yield self.image_to_tensor(image)
+        else:
+            with ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="annotation") as executor:
+                for image in ordered_map(executor, load_fn or load_frame, images, max_pending=num_workers * 4):
+                    yield self.process_image(image, processor_id=processor_id)
+
+    def embed_conditioning(self, conditioning, processor_id):
+        model = self.models[processor_id]
+        parameter = next(model.controlnet_conv_in.parameters())
+        return model.embed_conditioning(conditioning.to(device=parameter.device, dtype=parameter.dtype))
+
     def unit_count(self):
         return len(self.processors)
     
     def __call__(
         self,
         sample, timestep, encoder_hidden_states, conditionings,
-        tiled=False, tile_size=64, tile_stride=32
+        tiled=False, tile_size=64, tile_stride=32, processor_ids=None
     ):
+        # processor_ids: only run these ControlNets, e.g. one at a time when their weights are streamed
+        if processor_ids is None:
+            processor_ids = range(len(self.models))
         res_stack = None
-        for conditioning, model, scale in zip(conditionings, self.models, self.scales):
+        for processor_id in processor_ids:
+            conditioning, model, scale = conditionings[processor_id], self.models[processor_id], self.scales[processor_id]
             res_stack_ = model(
                 sample, timestep, encoder_hidden_states, conditioning,
                 tiled=tiled, tile_size=tile_size, tile_stride=tile_stride
@@ -1,8 +1,10 @@
 import warnings
 
-from PIL import Image
+import numpy as np
 from typing_extensions import Literal, TypeAlias
 
+from ..data.video import load_frame
+
 with warnings.catch_warnings():
     warnings.simplefilter("ignore")
     from controlnet_aux.processor import (
@@ -14,6 +16,10 @@ Processor_id: TypeAlias = Literal[
     "canny", "depth", "softedge", "lineart", "lineart_anime", "openpose", "tile"
 ]
 
+# Annotators without a neural network, they run in a process pool. The others stay on the GPU in the main process.
+# tile is only a resize, sending the frames to a process would cost more than it saves.
+cpu_processor_ids = ["canny"]
+
 class Annotator:
     def __init__(self, processor_id: Processor_id, model_path="models/Annotators", detect_resolution=None):
         if processor_id == "canny":
@@ -37,7 +43,8 @@ class Annotator:
         self.detect_resolution = detect_resolution
 
     def __call__(self, image):
-        image = Image.open(image)
+        if isinstance(image, str):
+            image = load_frame(image)
         width, height = image.size
         if self.processor_id == "openpose":
             kwargs = {
@@ -53,3 +60,14 @@ class Annotator:
         image = image.resize((width, height))
         return image
 
+
+# One Annotator per worker process and setting, created on first use.
+worker_annotators = {}
+
+
+def annotate_file(processor_id, detect_resolution, path):
+    # Runs in a worker process. Only the path is sent to the worker and only the array comes back.
+    key = (processor_id, detect_resolution)
+    if key not in worker_annotators:
+        worker_annotators[key] = Annotator(processor_id, detect_resolution=detect_resolution)
+    return np.array(worker_annotators[key](path))
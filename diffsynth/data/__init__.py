@@ -1 +1,6 @@
-from .video import VideoData, save_video, save_frames
+from .video import VideoData, save_video, save_frames, save_frame, load_frame, load_frame_array, frame_file_name, FrameSequence, IncrementalVideoWriter
+from .cache import DiskCacheManager, TieredCache, MemmapTensorStore, CacheManifest, config_hash, file_signature
+from .writer import BackgroundWriter
+from .prefetch import WindowPrefetcher
+from .checkpoint import LatentCheckpoint
+from .dedup import find_held_frames
@@ -0,0 +1,496 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+from PIL import Image
+
+
+def parse_size(size):
+    # Convert "32GiB", "500MB", "1.5G" or a plain number of bytes to bytes.
+    if size is None:
+        return None
+    if isinstance(size, (int, float)):
+        return int(size)
+    units = {
+        "": 1,
+        "b": 1,
+        "k": 1000, "kb": 1000, "kib": 1 << 10,
+        "m": 1000 ** 2, "mb": 1000 ** 2, "mib": 1 << 20,
+        "g": 1000 ** 3, "gb": 1000 ** 3, "gib": 1 << 30,
+        "t": 1000 ** 4, "tb": 1000 ** 4, "tib": 1 << 40,
+    }
+    text = str(size).strip().lower()
+    number = text.rstrip("abcdefghijklmnopqrstuvwxyz").strip()
+    unit = text[len(number):].strip()
+    if unit not in units or number == "":
+        raise ValueError(f"Cannot parse cache size: {size}")
+    return int(float(number) * units[unit])
+
+
+class CacheEntry:
+    def __init__(self, cache_class, path, size, priority=0, recompute_fn=None):
+        self.cache_class = cache_class
+        self.path = path
+        self.size = size
+        self.priority = priority
+        self.recompute_fn = recompute_fn
+
+    def evictable(self):
+        # Entries that cannot be rebuilt are never evicted, otherwise we would lose data.
+        return self.recompute_fn is not None
+
+
+class DiskCacheManager:
+    # Keeps every cache class (source_images, controlnet_caches, latents, smoother) below its byte budget.
+    # Files are evicted by priority first (lower goes first) and then by least recent use.
+    # An evicted file is rebuilt with its recompute_fn the next time somebody fetches it.
+    # With a BackgroundWriter, files are written on worker threads and only registered once they are complete.
+
+    def __init__(self, budgets=None, writer=None):
+        self.writer = writer
+        self.budgets = {}
+        self.sizes = {}
+        self.entries = {}
+        self.lru = {}
+        self.evicted = {}
+        # path -> threading.Event, set when the recompute_fn running for path has finished
+        self.recomputing = {}
+        # path -> number of users that need the file to stay on disk, see pin
+        self.pinned = {}
+        self.lock = threading.RLock()
+        self.warned = set()
+        for cache_class, budget in (budgets or {}).items():
+            self.set_budget(cache_class, budget)
+
+    def set_budget(self, cache_class, budget):
+        with self.lock:
+            self.budgets[cache_class] = parse_size(budget)
+            self.evict(cache_class)
+
+    def total_size(self, cache_class=None):
+        with self.lock:
+            if cache_class is None:
+                return sum(self.sizes.values())
+            return self.sizes.get(cache_class, 0)
+
+    def write(self, cache_class, path, write_fn, *args, priority=0, recompute_fn=None, callback=None):
+        # write_fn(path, *args) writes the file, in the background if there is a writer.
+        # callback(path) is called once the file is complete.
+        def on_done(path):
+            self.put(cache_class, path, priority=priority, recompute_fn=recompute_fn)
+            if callback is not None:
+                callback(path)
+        if self.writer is None:
+            write_fn(path, *args)
+            on_done(path)
+        else:
+            self.writer.submit(path, write_fn, *args, on_done=on_done)
+        return path
+
+    def load(self, path, load_fn):
+        # load_fn(path) reads the file, see TieredCache for the version that keeps hot entries in RAM.
+        self.fetch(path)
+        return load_fn(path)
+
+    def reserve(self, nbytes):
+        # Only TieredCache has RAM to give away.
+        return False
+
+    def wait(self, path):
+        # Must not be called while holding the lock, the writer threads need it to register their files.
+        if self.writer is not None:
+            self.writer.wait(path)
+
+    def flush(self, fsync=True):
+        if self.writer is not None:
+            self.writer.flush(fsync=fsync)
+
+    def put(self, cache_class, path, priority=0, recompute_fn=None):
+        # Register (or refresh) a file that has just been written.
+        with self.lock:
+            self.remove_entry(path)
+            self.evicted.pop(path, None)
+            entry = CacheEntry(cache_class, path, os.path.getsize(path), priority=priority, recompute_fn=recompute_fn)
+            self.entries[path] = entry
+            self.sizes[cache_class] = self.sizes.get(cache_class, 0) + entry.size
+            if entry.evictable():
+                self.lru.setdefault(cache_class, {}).setdefault(priority, OrderedDict())[path] = entry
+            self.evict(cache_class, keep=path)
+        return path
+
+    def track(self, cache_class, path, priority=0, recompute_fn=None):
+        # Files left over from an earlier run are only accounted for when they are used again.
+        self.wait(path)
+        with self.lock:
+            if path in self.entries:
+                self.touch(path)
+            else:
+                self.put(cache_class, path, priority=priority, recompute_fn=recompute_fn)
+        return path
+
+    def touch(self, path):
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry.evictable():
+                self.lru[entry.cache_class][entry.priority].move_to_end(path)
+
+    def fetch(self, path):
+        # Return a path that is guaranteed to exist, rebuilding the file if it was evicted.
+        # The entry is reserved under the lock, but recomputed without holding it, so a slow recompute_fn does not block
+        # other lookups, evictions or the writer threads. Concurrent fetches of the same path wait for the first one.
+        self.wait(path)
+        while True:
+            with self.lock:
+                if path in self.entries:
+                    self.touch(path)
+                    return path
+                if path in self.recomputing:
+                    done = self.recomputing[path]
+                elif path in self.evicted:
+                    cache_class, priority, recompute_fn = self.evicted.pop(path)
+                    done = self.recomputing[path] = threading.Event()
+                    break
+                else:
+                    return path
+            done.wait()
+        try:
+            recompute_fn()
+            with self.lock:
+                self.put(cache_class, path, priority=priority, recompute_fn=recompute_fn)
+        except BaseException:
+            with self.lock:
+                # Still missing, the next fetch tries again.
+                self.evicted[path] = (cache_class, priority, recompute_fn)
+            raise
+        finally:
+            with self.lock:
+                self.recomputing.pop(path, None)
+            done.set()
+        return path
+
+    def pin(self, path):
+        # The file is not evicted until unpin is called, e.g. while worker threads or processes still have to read it.
+        with self.lock:
+            self.pinned[path] = self.pinned.get(path, 0) + 1
+        return path
+
+    def unpin(self, path):
+        with self.lock:
+            if self.pinned.get(path, 0) <= 1:
+                self.pinned.pop(path, None)
+            else:
+                self.pinned[path] -= 1
+
+    def is_evicted(self, path):
+        with self.lock:
+            return path in self.evicted
+
+    def discard(self, path):
+        # The file is dead, delete it and forget about it.
+        self.wait(path)
+        with self.lock:
+            self.remove_entry(path)
+            self.evicted.pop(path, None)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def remove_entry(self, path):
+        entry = self.entries.pop(path, None)
+        if entry is None:
+            return None
+        self.sizes[entry.cache_class] -= entry.size
+        if entry.evictable():
+            self.lru[entry.cache_class][entry.priority].pop(path, None)
+        return entry
+
+    def evict(self, cache_class, keep=None):
+        budget = self.budgets.get(cache_class)
+        if budget is None:
+            return
+        queues = self.lru.get(cache_class, {})
+        for priority in sorted(queues):
+            for path in list(queues[priority]):
+                if self.sizes.get(cache_class, 0) <= budget:
+                    return
+                if path == keep or path in self.pinned:
+                    continue
+                entry = self.remove_entry(path)
+                if os.path.exists(path):
+                    os.remove(path)
+                self.evicted[path] = (entry.cache_class, entry.priority, entry.recompute_fn)
+        if self.sizes.get(cache_class, 0) > budget and cache_class not in self.warned:
+            self.warned.add(cache_class)
+            print(f"Cache {cache_class} exceeds its budget ({self.sizes[cache_class]} > {budget} bytes), but the remaining files cannot be recomputed.")
+
+
+class MemmapTensorStore:
+    # One preallocated file holding a (num_frames, *frame_shape) tensor.
+    # A second small file keeps one byte per frame, telling whether the frame has been written.
+    # If the files hold another number of frames of the same shape, they are moved to path + ".previous" and the store
+    # starts empty. remap copies the frames that are still needed from there and deletes the previous files.
+
+    dtype_dict = {
+        torch.float16: np.float16,
+        torch.float32: np.float32,
+        torch.uint8: np.uint8,
+        # numpy has no bfloat16, the bits are stored as int16 and reinterpreted when read
+        torch.bfloat16: np.int16,
+    }
+
+    def __init__(self, path, num_frames, frame_shape, dtype=torch.float16):
+        if dtype not in self.dtype_dict:
+            raise ValueError(f"Unsupported dtype for MemmapTensorStore: {dtype}")
+        self.path = path
+        self.done_path = path + ".done"
+        self.num_frames = num_frames
+        self.frame_shape = tuple(frame_shape)
+        self.dtype = dtype
+        np_dtype = self.dtype_dict[dtype]
+        shape = (num_frames,) + self.frame_shape
+        nbytes = int(np.prod(shape)) * np.dtype(np_dtype).itemsize
+        self.nbytes = nbytes
+        self.memory = None
+        stored_frames = self.count_frames(path, self.done_path)
+        reuse = stored_frames == num_frames
+        previous_path, previous_done_path = path + ".previous", self.done_path + ".previous"
+        if not reuse and stored_frames > 0 and not os.path.exists(previous_path):
+            os.replace(self.done_path, previous_done_path)
+            os.replace(path, previous_path)
+        mode = "r+" if reuse else "w+"
+        self.data = np.memmap(path, dtype=np_dtype, mode=mode, shape=shape)
+        self.done = np.memmap(self.done_path, dtype=np.uint8, mode=mode, shape=(num_frames,))
+        # Also left behind if the process stopped before remap was done.
+        self.previous_frames = self.count_frames(previous_path, previous_done_path)
+        self.previous = None
+        if self.previous_frames > 0:
+            self.previous = (
+                np.memmap(previous_path, dtype=np_dtype, mode="r", shape=(self.previous_frames,) + self.frame_shape),
+                np.memmap(previous_done_path, dtype=np.uint8, mode="r", shape=(self.previous_frames,)),
+            )
+
+    def count_frames(self, path, done_path):
+        # Number of frames of this shape and dtype in path and its flag file done_path, 0 if they do not fit.
+        if not os.path.exists(path) or not os.path.exists(done_path):
+            return 0
+        frame_nbytes = int(np.prod(self.frame_shape)) * np.dtype(self.dtype_dict[self.dtype]).itemsize
+        size = os.path.getsize(path)
+        if size % frame_nbytes != 0 or os.path.getsize(done_path) != size // frame_nbytes:
+            return 0
+        return size // frame_nbytes
+
+    def remap(self, source_ids):
+        # source_ids[index]: frame of the previous store with the content of frame index, or None.
+        # Returns the frames that were copied.
+        copied = []
+        if self.previous is not None:
+            data, done = self.previous
+            for index, source_id in enumerate(source_ids):
+                if source_id is not None and source_id < self.previous_frames and done[source_id]:
+                    self.data[index] = data[source_id]
+                    self.done[index] = 1
+                    copied.append(index)
+            self.flush()
+            self.previous = None
+            del data, done
+        for previous_path in [self.path + ".previous", self.done_path + ".previous"]:
+            if os.path.exists(previous_path):
+                os.remove(previous_path)
+        self.previous_frames = 0
+        return copied
+
+    def __len__(self):
+        return self.num_frames
+
+    def __getitem__(self, index):
+        # Zero-copy view on the mapped file (or on the RAM copy), e.g. store[batch_id: batch_id_]
+        if self.memory is not None:
+            return self.to_tensor(self.memory[index])
+        return self.to_tensor(self.data[index])
+
+    def to_tensor(self, array):
+        tensor = torch.from_numpy(array)
+        if self.dtype == torch.bfloat16:
+            tensor = tensor.view(torch.bfloat16)
+        return tensor
+
+    def __setitem__(self, index, value):
+        value = value.to(self.dtype).cpu()
+        if self.dtype == torch.bfloat16:
+            value = value.view(torch.int16)
+        value = value.numpy()
+        if self.memory is not None:
+            self.memory[index] = value
+        self.data[index] = value
+        self.done[index] = 1
+        # Only the small flag file is synced per write, msyncing the whole data mapping every time would be O(N^2).
+        # The mapping shares the page cache, so a crash of the process loses nothing, flush() persists the data.
+        self.done.flush()
+
+    def is_done(self, index):
+        return bool(self.done[index])
+
+    def missing_frames(self):
+        return [i for i in range(self.num_frames) if not self.done[i]]
+
+    def flush(self):
+        # Call when a batch of frames is complete, e.g. after preparing a ControlNet cache.
+        self.data.flush()
+        self.done.flush()
+
+    def load_to_memory(self):
+        # Reads the whole file once, afterwards the windows are served from RAM.
+        self.memory = np.array(self.data)
+
+
+class TieredCache(DiskCacheManager):
+    # DiskCacheManager with a RAM tier: the most recently used entries (up to ram_budget bytes) are also kept in memory,
+    # colder entries are only read back from the files on disk. Files are still always written, so resuming works as before.
+    # Values are stored as read-only numpy arrays, exactly what load_fn would return for the file.
+
+    def __init__(self, budgets=None, writer=None, ram_budget=0):
+        super().__init__(budgets, writer=writer)
+        self.ram_budget = parse_size(ram_budget) or 0
+        self.ram_size = 0
+        self.ram_reserved = 0
+        self.memory = OrderedDict()
+
+    def remember(self, path, value, copy=False):
+        # copy: value still belongs to the caller, who may modify it afterwards (see write).
+        # Otherwise a read-only view is stored, the flags of the caller's array are not touched.
+        nbytes = self.estimate_nbytes(value)
+        with self.lock:
+            self.forget(path)
+            if nbytes > self.ram_budget - self.ram_reserved:
+                return
+        if copy and isinstance(value, np.ndarray):
+            value = value.copy()
+        else:
+            value = np.asarray(value).view()
+        value.flags.writeable = False
+        with self.lock:
+            self.forget(path)
+            self.memory[path] = value
+            self.ram_size += value.nbytes
+            while self.ram_size > self.ram_budget - self.ram_reserved:
+                _, cold_value = self.memory.popitem(last=False)
+                self.ram_size -= cold_value.nbytes
+
+    def estimate_nbytes(self, value):
+        # Size of the value as a numpy array, without converting it (e.g. a PIL image)
+        if isinstance(value, np.ndarray):
+            return value.nbytes
+        if isinstance(value, Image.Image):
+            return value.width * value.height * len(value.getbands())
+        return np.asarray(value).nbytes
+
+    def forget(self, path):
+        with self.lock:
+            value = self.memory.pop(path, None)
+            if value is not None:
+                self.ram_size -= value.nbytes
+
+    def load(self, path, load_fn):
+        with self.lock:
+            if path in self.memory:
+                self.memory.move_to_end(path)
+                self.touch(path)
+                return self.memory[path]
+        value = super().load(path, load_fn)
+        self.remember(path, value)
+        return self.memory.get(path, value)
+
+    def write(self, cache_class, path, write_fn, *args, **kwargs):
+        # args[0] is the value that is written, e.g. write("latents", path, save_frame, image)
+        if len(args) > 0:
+            self.remember(path, args[0], copy=True)
+        return super().write(cache_class, path, write_fn, *args, **kwargs)
+
+    def discard(self, path):
+        self.forget(path)
+        super().discard(path)
+
+    def reserve(self, nbytes):
+        # Take a fixed amount of RAM out of the budget, e.g. for a ControlNet cache that is loaded as a whole.
+        with self.lock:
+            if self.ram_reserved + nbytes > self.ram_budget:
+                return False
+            self.ram_reserved += nbytes
+            while self.ram_size > self.ram_budget - self.ram_reserved:
+                _, cold_value = self.memory.popitem(last=False)
+                self.ram_size -= cold_value.nbytes
+            return True
+
+
+def config_hash(**kwargs):
+    text = json.dumps(kwargs, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, int(stat.st_mtime)]
+
+
+class CacheManifest:
+    # manifest.json in a cache folder: entry name -> hash of the parameters that produced the entry.
+    # Entries whose hash does not match the current parameters are stale and must be recomputed,
+    # so the caches can be kept even if clear_output_folder is false and some settings changed.
+
+    instances = {}
+    instances_lock = threading.Lock()
+
+    @staticmethod
+    def open(folder):
+        # One instance per folder, shared by everybody who reads or writes the folder.
+        folder = os.path.abspath(folder)
+        with CacheManifest.instances_lock:
+            if folder not in CacheManifest.instances:
+                CacheManifest.instances[folder] = CacheManifest(folder)
+            return CacheManifest.instances[folder]
+
+    def __init__(self, folder, autosave_every=200):
+        self.path = os.path.join(folder, "manifest.json")
+        self.autosave_every = autosave_every
+        self.lock = threading.RLock()
+        self.entries = {}
+        self.dirty = 0
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, encoding="utf-8") as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                print(f"Cannot read {self.path}, all entries of this cache will be recomputed.")
+
+    def get(self, name):
+        with self.lock:
+            return self.entries.get(name)
+
+    def is_valid(self, name, key):
+        return self.get(name) == key
+
+    def set(self, name, key):
+        with self.lock:
+            self.entries[name] = key
+            self.dirty += 1
+            if self.dirty >= self.autosave_every:
+                self.save()
+
+    def invalidate(self, name):
+        with self.lock:
+            if self.entries.pop(name, None) is not None:
+                self.dirty += 1
+
+    def save(self):
+        with self.lock:
+            if self.dirty == 0:
+                return
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(self.entries, f)
+            os.replace(temp_path, self.path)
+            self.dirty = 0
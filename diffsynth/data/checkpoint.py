@@ -0,0 +1,136 @@
+import os
+import shutil
+from concurrent.futures import wait
+
+import torch
+
+from .writer import fsync_file
+
+
+class LatentCheckpoint:
+    # latents.pt in the output folder holds {"progress_id": ..., "latents": ...}, so the step id and the latents can never disagree.
+    # Extra keyword arguments of save (num_frames, frame_key) are stored next to them, the caller checks them on load.
+    # The file is written to a temporary file first and then renamed, a crash never leaves a broken checkpoint behind.
+    # With a BackgroundWriter the checkpoint is persisted in the background, after every cache file written before it.
+
+    def __init__(self, output_folder, writer=None, keep_snapshots=0, dtype=torch.float16):
+        self.output_folder = output_folder
+        self.path = os.path.join(output_folder, "latents.pt")
+        # Progress inside the step that is currently running, see save_partial
+        self.partial_path = os.path.join(output_folder, "latents_partial.pt")
+        # Copies of a memory-mapped accumulator, used in turns so that the one of the last partial checkpoint stays intact
+        self.partial_accumulator_paths = [os.path.join(output_folder, f"accumulator_partial_{i}.bin") for i in range(2)]
+        # Files the partial checkpoint on disk refers to
+        self.partial_files = []
+        self.snapshot_folder = os.path.join(output_folder, "latents_snapshots")
+        self.writer = writer
+        self.keep_snapshots = keep_snapshots
+        self.dtype = dtype
+        # Written by older versions
+        self.legacy_latents_path = os.path.join(output_folder, "latents.py")
+        self.legacy_process_id_path = os.path.join(output_folder, "last_process_id.txt")
+        self.legacy_accumulator_path = os.path.join(output_folder, "accumulator.bin.checkpoint")
+
+    def snapshot_path(self, progress_id):
+        return os.path.join(self.snapshot_folder, f"latents_{progress_id}.pt")
+
+    def list_snapshots(self):
+        if not os.path.exists(self.snapshot_folder):
+            return []
+        progress_ids = []
+        for file_name in os.listdir(self.snapshot_folder):
+            if file_name.startswith("latents_") and file_name.endswith(".pt"):
+                progress_ids.append(int(file_name[len("latents_"): -len(".pt")]))
+        return [self.snapshot_path(progress_id) for progress_id in sorted(progress_ids, reverse=True)]
+
+    def load(self):
+        # Returns the checkpoint dict, or None if there is nothing to resume from.
+        for path in [self.path] + self.list_snapshots():
+            if os.path.exists(path):
+                try:
+                    return torch.load(path)
+                except Exception as e:
+                    print(f"Cannot load checkpoint {path}: {e}")
+        if os.path.exists(self.legacy_latents_path) and os.path.exists(self.legacy_process_id_path):
+            with open(self.legacy_process_id_path) as f:
+                progress_id = int(f.read())
+            return {"progress_id": progress_id, "latents": torch.load(self.legacy_latents_path)}
+        return None
+
+    def save(self, progress_id, latents, **kwargs):
+        state = {"progress_id": progress_id, "latents": latents.to(self.dtype), **kwargs}
+        if self.writer is None:
+            self.write(self.path, state)
+        else:
+            self.writer.submit(self.path, self.write, state, after=self.writer.barrier())
+
+    def save_partial(self, progress_id, key, blocking=False, accumulator_file=None, **kwargs):
+        # Window accumulators of an unfinished step. key identifies the settings they were computed with.
+        # blocking: written before returning, for tensors that are modified afterwards (no copy is made)
+        # accumulator_file: a memory-mapped accumulator, a copy of the file is stored as accumulator_path
+        state = {"progress_id": progress_id, "key": key, **kwargs}
+        if self.writer is None or blocking or accumulator_file is not None:
+            if self.writer is not None:
+                # Everything submitted before, including older partial checkpoints, comes first.
+                wait(self.writer.barrier())
+            if accumulator_file is not None:
+                accumulator_path = [path for path in self.partial_accumulator_paths if path not in self.partial_files][0]
+                shutil.copyfile(accumulator_file, accumulator_path)
+                fsync_file(accumulator_path)
+                state["accumulator_path"] = accumulator_path
+            self.write(self.partial_path, state)
+        else:
+            self.writer.submit(self.partial_path, self.write, state, after=self.writer.barrier())
+
+    def load_partial(self, progress_id, key):
+        if not os.path.exists(self.partial_path):
+            return None
+        try:
+            state = torch.load(self.partial_path)
+        except Exception as e:
+            print(f"Cannot load checkpoint {self.partial_path}: {e}")
+            return None
+        if state.get("progress_id") != progress_id or state.get("key") != key:
+            return None
+        self.partial_files = [state["accumulator_path"]] if "accumulator_path" in state else []
+        return state
+
+    def remove_partial(self):
+        # Called once the step of the partial checkpoint is saved completely. Partial checkpoints of the next step are
+        # only written after it (save_partial waits for the writer), so nothing newer is removed.
+        for path in [self.partial_path, self.legacy_accumulator_path] + self.partial_accumulator_paths:
+            if os.path.exists(path):
+                os.remove(path)
+        self.partial_files = []
+
+    def write(self, path, state):
+        temp_path = path + ".tmp"
+        torch.save(state, temp_path)
+        fsync_file(temp_path)
+        if self.writer is not None:
+            # Everything the checkpoint depends on must be on disk before it becomes visible.
+            self.writer.sync()
+        os.replace(temp_path, path)
+        if path == self.partial_path:
+            # The accumulator copy of the previous partial checkpoint is not needed any more.
+            partial_files = [state["accumulator_path"]] if "accumulator_path" in state else []
+            for old_path in self.partial_files:
+                if old_path not in partial_files and os.path.exists(old_path):
+                    os.remove(old_path)
+            self.partial_files = partial_files
+        if path == self.path:
+            self.remove_partial()
+            if self.keep_snapshots > 0:
+                self.make_snapshot(path, state["progress_id"])
+
+    def make_snapshot(self, path, progress_id):
+        os.makedirs(self.snapshot_folder, exist_ok=True)
+        snapshot_path = self.snapshot_path(progress_id)
+        if os.path.exists(snapshot_path):
+            os.remove(snapshot_path)
+        try:
+            os.link(path, snapshot_path)
+        except OSError:
+            shutil.copy(path, snapshot_path)
+        for old_path in self.list_snapshots()[self.keep_snapshots:]:
+            os.remove(old_path)
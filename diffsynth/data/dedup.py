@@ -0,0 +1,46 @@
+import hashlib
+
+import numpy as np
+
+from .video import load_frame_array
+
+
+def frame_thumbnail(image, block_size=8):
+    # Grayscale, averaged over block_size x block_size pixels. Noise and compression artifacts mostly cancel out.
+    height = image.shape[0] // block_size * block_size
+    width = image.shape[1] // block_size * block_size
+    gray = image[:height, :width].astype(np.float32).mean(axis=-1)
+    return gray.reshape(height // block_size, block_size, width // block_size, block_size).mean(axis=(1, 3))
+
+
+class FrameSignature:
+    def __init__(self, image):
+        self.digest = hashlib.sha1(np.ascontiguousarray(image).tobytes()).hexdigest()
+        self.thumbnail = frame_thumbnail(image)
+
+    def matches(self, other, threshold):
+        # threshold: mean absolute difference of the thumbnails (0-255), 0 only accepts identical frames
+        if self.digest == other.digest:
+            return True
+        if threshold <= 0 or self.thumbnail.shape != other.thumbnail.shape:
+            return False
+        return np.abs(self.thumbnail - other.thumbnail).mean() <= threshold
+
+
+def find_held_frames(sequences, threshold=1.0, cache_manager=None, progress_bar_cmd=lambda x, **kwargs: x):
+    # Animation on twos or threes holds every drawing for several frames.
+    # sequences: frame lists of equal length (input frames, ControlNet frames of other videos, ...)
+    # A frame is held if it matches the first frame of the current run in every sequence.
+    # Comparing with the first frame instead of the previous one keeps slow pans from drifting into one run.
+    # Returns (unique_ids, frame_map): the frames to render, and for every frame the position of its render in unique_ids.
+    load = (lambda path: cache_manager.load(path, load_frame_array)) if cache_manager is not None else load_frame_array
+    num_frames = len(sequences[0])
+    unique_ids, frame_map = [], []
+    reference = None
+    for frame_id in progress_bar_cmd(range(num_frames), desc="Find held frames"):
+        signatures = [FrameSignature(load(frames[frame_id])) for frames in sequences]
+        if reference is None or not all(s.matches(r, threshold) for s, r in zip(signatures, reference)):
+            reference = signatures
+            unique_ids.append(frame_id)
+        frame_map.append(len(unique_ids) - 1)
+    return unique_ids, frame_map
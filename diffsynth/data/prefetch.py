@@ -0,0 +1,105 @@
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+
+def sliding_windows(num_frames, window_size, stride):
+    windows = []
+    for start in range(0, num_frames, stride):
+        end = min(start + window_size, num_frames)
+        windows.append((start, end))
+        if end == num_frames:
+            break
+    return windows
+
+
+def background_iter(iterable, max_size=8):
+    # Runs the iterable on its own thread, at most max_size items ahead of the consumer.
+    # Chaining these connects the stages of a pipeline with bounded queues. Exceptions are raised in the consumer.
+    items = queue.Queue(maxsize=max_size)
+    stop = threading.Event()
+    end = object()
+
+    def put(entry):
+        while not stop.is_set():
+            try:
+                items.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((end, None))
+        except BaseException as e:
+            put((end, e))
+
+    thread = threading.Thread(target=produce, name="pipeline_stage", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is end:
+                break
+            yield item
+    finally:
+        # The consumer stopped early (or failed), let the producer finish.
+        stop.set()
+        thread.join()
+
+
+class WindowPrefetcher:
+    # Prepares the inputs of window k+1 on a worker thread while window k is being denoised.
+    # ControlNet frames shared by neighbouring windows are kept in a small LRU, so they are only read once.
+
+    def __init__(self, windows, sample, controlnet_stores=None, cache_size=0, pin_memory=False):
+        self.windows = windows
+        self.sample = sample
+        self.controlnet_stores = controlnet_stores or []
+        self.cache_size = cache_size
+        self.pin_memory = pin_memory
+        self.cache = OrderedDict()
+
+    def __len__(self):
+        return len(self.windows)
+
+    def controlnet_frame(self, index):
+        # (num_processors, 3, height, width)
+        if index in self.cache:
+            self.cache.move_to_end(index)
+            return self.cache[index]
+        frame = torch.stack([store[index] for store in self.controlnet_stores])
+        self.cache[index] = frame
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return frame
+
+    def load(self, start, end):
+        sample = self.sample[start: end]
+        controlnet_frames = None
+        if len(self.controlnet_stores) > 0:
+            controlnet_frames = torch.stack([self.controlnet_frame(i) for i in range(start, end)], dim=1)
+        if self.pin_memory:
+            # Pinned memory lets the main thread copy to the GPU with non_blocking=True.
+            sample = sample.pin_memory()
+            if controlnet_frames is not None:
+                controlnet_frames = controlnet_frames.pin_memory()
+        return sample, controlnet_frames
+
+    def __iter__(self):
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="window_prefetch") as executor:
+            future = executor.submit(self.load, *self.windows[0]) if len(self.windows) > 0 else None
+            for window_id, (start, end) in enumerate(self.windows):
+                sample, controlnet_frames = future.result()
+                if window_id + 1 < len(self.windows):
+                    future = executor.submit(self.load, *self.windows[window_id + 1])
+                yield start, end, sample, controlnet_frames
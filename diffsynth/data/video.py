@@ -1,11 +1,15 @@
 import os
+import queue
 import shutil
+import threading
 
 import imageio
 import numpy as np
 from PIL import Image, ImageOps
 from tqdm import tqdm
 
+from .cache import CacheManifest, config_hash, file_signature
+
 
 class LowMemoryVideo:
     def __init__(self, file_name):
@@ -117,22 +121,107 @@ def resize_and_fill(image, height, width):
             image.paste(bottom_pad, (0, image_height))
     return image
 
+# Intermediate frames (source_images, latents, smoother) can be stored in a faster format than png.
+# The format is chosen by the file extension, png is still used for the final output.
+frame_formats = ["png", "npy", "lz4"]
+
+
+def frame_file_name(name, frame_format="png"):
+    if frame_format not in frame_formats:
+        raise ValueError(f"Unsupported frame format: {frame_format}, choose from {frame_formats}")
+    return f"{name}.{frame_format}"
+
+
+def save_frame(path, image):
+    # image: PIL.Image or uint8 array (height, width, 3)
+    # Written to a temporary file and renamed, so hardlinks to the previous version (e.g. in frames/) keep their content.
+    root, extension = os.path.splitext(path)
+    temp_path = root + ".tmp" + extension
+    if path.endswith(".npy"):
+        np.save(temp_path, np.asarray(image, dtype=np.uint8))
+    elif path.endswith(".lz4"):
+        import lz4.frame
+        image = np.ascontiguousarray(np.asarray(image, dtype=np.uint8))
+        with open(temp_path, "wb") as f:
+            f.write(np.array(image.shape, dtype=np.int32).tobytes())
+            f.write(lz4.frame.compress(image.tobytes()))
+    else:
+        if isinstance(image, np.ndarray):
+            image = Image.fromarray(image)
+        image.save(temp_path)
+    os.replace(temp_path, path)
+
+
+def link_or_copy(source, target):
+    # A hardlink costs no space and no time, file systems without hardlinks get a copy.
+    if os.path.exists(target):
+        os.remove(target)
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy(source, target)
+
+
+def load_frame_array(path):
+    if path.endswith(".npy"):
+        return np.load(path)
+    elif path.endswith(".lz4"):
+        import lz4.frame
+        with open(path, "rb") as f:
+            shape = tuple(np.frombuffer(f.read(12), dtype=np.int32))
+            data = lz4.frame.decompress(f.read())
+        return np.frombuffer(data, dtype=np.uint8).reshape(shape)
+    else:
+        return np.array(Image.open(path).convert("RGB"))
+
+
+class FrameSequence:
+    # Frame files as a list of arrays that are only read when indexed, for code that takes in-memory frame lists (FastBlend runners).
+    def __init__(self, frames, cache_manager=None):
+        self.frames = frames
+        self.cache_manager = cache_manager
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, item):
+        if self.cache_manager is not None:
+            return self.cache_manager.load(self.frames[item], load_frame_array)
+        return load_frame_array(self.frames[item])
+
+
+def load_frame(path):
+    if path.endswith(".npy") or path.endswith(".lz4"):
+        return Image.fromarray(load_frame_array(path))
+    return Image.open(path).convert("RGB")
+
+
 class VideoData:
-    def __init__(self, video_file=None, image_folder=None, image_cache_folder="image_cache", height=None, width=None, **kwargs):
+    def __init__(self, video_file=None, image_folder=None, image_cache_folder="image_cache", height=None, width=None, cache_manager=None, frame_format="png", **kwargs):
         self.cache_folder = image_cache_folder
+        self.frame_format = frame_format
+        self.cache_manager = cache_manager
         if not os.path.exists(self.cache_folder):
             os.makedirs(self.cache_folder, exist_ok=True)
+        self.manifest = CacheManifest.open(self.cache_folder)
         if video_file is not None:
             self.data_type = "video"
             self.data = LowMemoryVideo(video_file, **kwargs)
+            self.source = file_signature(video_file)
         elif image_folder is not None:
             self.data_type = "images"
             self.data = LowMemoryImageFolder(image_folder, **kwargs)
+            self.source = None
         else:
             raise ValueError("Cannot open video or image folder")
         self.length = None
         self.set_shape(height, width)
 
+    def frame_key(self, item):
+        # Everything that changes the content of a cached frame.
+        source = self.source if self.data_type == "video" else file_signature(self.data.file_list[item])
+        return config_hash(source=source, item=item, height=self.height, width=self.width)
+
     def raw_data(self):
         frames = []
         for i in range(self.__len__()):
@@ -160,16 +249,38 @@ class VideoData:
             return height, width
 
     def __getitem__(self, item):
-        path = f"{self.cache_folder}/{item}.png"
-        if os.path.exists(path):
+        name = frame_file_name(item, self.frame_format)
+        path = f"{self.cache_folder}/{name}"
+        key = self.frame_key(item)
+        if self.cache_manager is None:
+            if not os.path.exists(path) or not self.manifest.is_valid(name, key):
+                self.make_frame(item, path)
+                self.manifest.set(name, key)
             return path
+        recompute_fn = lambda: self.make_frame(item, path)
+        self.cache_manager.wait(path)
+        if not os.path.exists(path) or not self.manifest.is_valid(name, key):
+            # The entry only becomes valid again once the new file is complete.
+            self.manifest.invalidate(name)
+            # Decoding stays on this thread (the video reader is not thread-safe), only the file is written in the background.
+            self.cache_manager.write(
+                "source_images", path, save_frame, self.decode_frame(item), priority=1, recompute_fn=recompute_fn,
+                callback=lambda path: self.manifest.set(name, key)
+            )
+        else:
+            self.cache_manager.track("source_images", path, priority=1, recompute_fn=recompute_fn)
+        return path
+
+    def decode_frame(self, item):
         frame = self.data.__getitem__(item)
         width, height = frame.size
         if self.height is not None and self.width is not None:
             if self.height != height or self.width != width:
                 frame = resize_and_fill(frame, self.height, self.width)
-        frame.save(path)
-        return path
+        return frame
+
+    def make_frame(self, item, path):
+        save_frame(path, self.decode_frame(item))
 
     def __del__(self):
         pass
@@ -181,17 +292,103 @@ class VideoData:
             frame.save(os.path.join(folder, f"{i}.png"))
 
 
-def save_video(frames, save_path, fps, quality=9):
+def save_video(frames, save_path, fps, quality=9, cache_manager=None):
     writer = imageio.get_writer(save_path, fps=fps, quality=quality)
     for frame in tqdm(frames, desc="Saving video"):
         if isinstance(frame, str):
-            frame = np.array(Image.open(frame))
+            frame = cache_manager.load(frame, load_frame_array) if cache_manager is not None else load_frame_array(frame)
         writer.append_data(np.array(frame))
     writer.close()
 
 
-def save_frames(frames, save_path):
+def save_frames(frames, save_path, cache_manager=None):
     os.makedirs(save_path, exist_ok=True)
     for i, frame in enumerate(tqdm(frames, desc="Saving images")):
-        shutil.copy(frame, os.path.join(save_path, f"{i}.png"))
+        if not isinstance(frame, str):
+            save_frame(os.path.join(save_path, f"{i}.png"), frame)
+            continue
+        if cache_manager is not None:
+            cache_manager.fetch(frame)
+        if frame.endswith(".png"):
+            link_or_copy(frame, os.path.join(save_path, f"{i}.png"))
+        else:
+            # Intermediate formats are converted, the exported frames are always png.
+            save_frame(os.path.join(save_path, f"{i}.png"), load_frame_array(frame))
         # frame.save(os.path.join(save_path, f"{i}.png"))
+
+
+class IncrementalVideoWriter:
+    # Exports the output while it is being produced: every frame added is linked into frames/ and appended to video.mp4
+    # on a background thread, so nothing is left to do at the end of the run.
+    # frame_map (see find_held_frames) repeats the added frames on the original timeline.
+
+    def __init__(self, output_folder, fps, quality=9, cache_manager=None, frame_map=None, max_pending=16):
+        self.frames_folder = os.path.join(output_folder, "frames")
+        os.makedirs(self.frames_folder, exist_ok=True)
+        self.video_path = os.path.join(output_folder, "video.mp4")
+        self.fps = fps
+        self.quality = quality
+        self.cache_manager = cache_manager
+        self.frame_map = frame_map
+        self.frames = queue.Queue(maxsize=max_pending)
+        self.num_added = 0
+        self.num_written = 0
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name="video_writer", daemon=True)
+        self.thread.start()
+
+    def add(self, frame):
+        # frame: path of the next output frame, or the image itself (e.g. from a PIL editor in the smoother)
+        if self.error is not None:
+            raise RuntimeError("Video export failed") from self.error
+        self.frames.put((self.num_added, frame))
+        self.num_added += 1
+
+    def repeats(self, index):
+        if self.frame_map is None:
+            return [index]
+        # frame_map is sorted, the frames of one drawing are consecutive
+        frame_ids = []
+        frame_id = self.num_written
+        while frame_id < len(self.frame_map) and self.frame_map[frame_id] == index:
+            frame_ids.append(frame_id)
+            frame_id += 1
+        return frame_ids
+
+    def run(self):
+        writer = imageio.get_writer(self.video_path, fps=self.fps, quality=self.quality)
+        try:
+            while True:
+                index, frame = self.frames.get()
+                if frame is None:
+                    break
+                if isinstance(frame, str):
+                    image = self.cache_manager.load(frame, load_frame_array) if self.cache_manager is not None else load_frame_array(frame)
+                else:
+                    image = np.array(frame)
+                first_path = None
+                for frame_id in self.repeats(index):
+                    path = os.path.join(self.frames_folder, f"{frame_id}.png")
+                    if first_path is not None:
+                        link_or_copy(first_path, path)
+                    elif isinstance(frame, str) and frame.endswith(".png"):
+                        link_or_copy(frame, path)
+                    else:
+                        # Intermediate formats are converted, the exported frames are always png.
+                        save_frame(path, image)
+                    first_path = first_path or path
+                    writer.append_data(image)
+                    self.num_written = frame_id + 1
+        except BaseException as e:
+            self.error = e
+            # keep draining, add() must not block forever
+            while self.frames.get()[1] is not None:
+                pass
+        finally:
+            writer.close()
+
+    def close(self):
+        self.frames.put((self.num_added, None))
+        self.thread.join()
+        if self.error is not None:
+            raise RuntimeError("Video export failed") from self.error
@@ -0,0 +1,87 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+
+def fsync_file(path):
+    # "rb+" instead of "rb", os.fsync needs write access on Windows.
+    with open(path, "rb+") as f:
+        os.fsync(f.fileno())
+
+
+class BackgroundWriter:
+    # Runs cache writes (png, npy, pt) on worker threads, so that the GPU does not wait on the disk.
+    # At most max_pending writes are queued, submit blocks when the queue is full.
+    # Writes to the same path are executed in the order they were submitted.
+
+    def __init__(self, num_workers=2, max_pending=64):
+        self.executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="cache_writer")
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.unsynced = set()
+        self.errors = []
+
+    def submit(self, path, write_fn, *args, after=None, on_done=None):
+        # write_fn(path, *args) runs on a worker thread, then on_done(path).
+        # after: futures that must be finished first, e.g. writer.barrier()
+        self.slots.acquire()
+        with self.lock:
+            depends = list(after or [])
+            if path in self.pending:
+                depends.append(self.pending[path])
+            future = self.executor.submit(self.run, path, write_fn, args, depends, on_done)
+            self.pending[path] = future
+        future.add_done_callback(lambda f: self.release(path, f))
+        return future
+
+    def run(self, path, write_fn, args, depends, on_done):
+        # The executor is FIFO, so everything we depend on is already running or finished.
+        wait(depends)
+        write_fn(path, *args)
+        with self.lock:
+            self.unsynced.add(path)
+        if on_done is not None:
+            on_done(path)
+
+    def release(self, path, future):
+        with self.lock:
+            if self.pending.get(path) is future:
+                self.pending.pop(path)
+            if future.exception() is not None:
+                self.errors.append((path, future.exception()))
+        self.slots.release()
+
+    def barrier(self):
+        # All writes submitted so far.
+        with self.lock:
+            return list(self.pending.values())
+
+    def wait(self, path):
+        # Block until the file is completely written.
+        with self.lock:
+            future = self.pending.get(path)
+        if future is not None:
+            wait([future])
+
+    def sync(self):
+        # fsync every finished write that has not been synced yet.
+        with self.lock:
+            paths, self.unsynced = self.unsynced, set()
+        for path in paths:
+            if os.path.exists(path):
+                fsync_file(path)
+
+    def flush(self, fsync=True):
+        wait(self.barrier())
+        with self.lock:
+            errors, self.errors = self.errors, []
+        if len(errors) > 0:
+            path, error = errors[0]
+            raise RuntimeError(f"{len(errors)} background write(s) failed, the first one is {path}") from error
+        if fsync:
+            self.sync()
+
+    def close(self):
+        self.flush()
+        self.executor.shutdown()
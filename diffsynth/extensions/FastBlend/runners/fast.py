@@ -7,11 +7,39 @@ from PIL import Image
 from tqdm import tqdm
 
 from ..patch_match import PyramidPatchMatcher
+from ....data.video import load_frame_array
 
 
 class TableManager:
-    def __init__(self):
-        pass
+    def __init__(self, cache_manager=None):
+        self.cache_manager = cache_manager
+        self.saved_paths = set()
+
+    def load_image(self, frame):
+        path = frame.tolist() if isinstance(frame, np.ndarray) else frame
+        if self.cache_manager is not None:
+            return self.cache_manager.load(path, load_frame_array)
+        return load_frame_array(path)
+
+    def save_table(self, npy_path, data):
+        self.saved_paths.add(npy_path)
+        if self.cache_manager is not None:
+            # Tables cannot be rebuilt cheaply, so they are pinned until they are released.
+            self.cache_manager.write("smoother", npy_path, numpy.save, data)
+        else:
+            numpy.save(npy_path, data)
+
+    def load_table(self, npy_path):
+        if self.cache_manager is not None:
+            return self.cache_manager.load(npy_path, numpy.load)
+        return numpy.load(npy_path)
+
+    def release_tables(self):
+        # Called when the blended frames are ready and the tables are not needed any more.
+        if self.cache_manager is not None:
+            for npy_path in self.saved_paths:
+                self.cache_manager.discard(npy_path)
+        self.saved_paths = set()
 
     def task_list(self, n):
         tasks = []
@@ -41,29 +69,29 @@ class TableManager:
         remapping_table = []
         for i in range(n):
             npy_path = os.path.join(cache_folder, f"{i}_0.npy")
-            image_data = np.array(Image.open(frames_style[i].tolist()))
-            numpy.save(npy_path, image_data)
+            image_data = self.load_image(frames_style[i])
+            self.save_table(npy_path, image_data)
             remapping_table.append([(npy_path, 1)])
         # remapping_table = [[(np.array(Image.open(frames_style[i].tolist())), 1)] for i in range(n)]
         for batch_id in tqdm(range(0, len(tasks), batch_size), desc=desc):
             tasks_batch = tasks[batch_id: min(batch_id + batch_size, len(tasks))]
-            source_guide = np.stack([np.array(Image.open(frames_guide[task["source"]].tolist())) for task in tasks_batch])
-            target_guide = np.stack([np.array(Image.open(frames_guide[task["target"]].tolist())) for task in tasks_batch])
-            source_style = np.stack([np.array(Image.open(frames_style[task["source"]].tolist())) for task in tasks_batch])
+            source_guide = np.stack([self.load_image(frames_guide[task["source"]]) for task in tasks_batch])
+            target_guide = np.stack([self.load_image(frames_guide[task["target"]]) for task in tasks_batch])
+            source_style = np.stack([self.load_image(frames_style[task["source"]]) for task in tasks_batch])
             _, target_style = patch_match_engine.estimate_nnf(source_guide, target_guide, source_style)
             for task, result in zip(tasks_batch, target_style):
                 target, level = task["target"], task["level"]
                 if len(remapping_table[target])==level:
                     npy_path = os.path.join(cache_folder, f"{target}_{level}.npy")
-                    numpy.save(npy_path, result)
+                    self.save_table(npy_path, result)
                     remapping_table[target].append((npy_path, 1))
                 else:
                     frame, weight = remapping_table[target][level]
                     if isinstance(frame, str):
-                        frame = numpy.load(frame)
+                        frame = self.load_table(frame)
                     frame = frame * (weight / (weight + 1)) + result / (weight + 1)
                     npy_path = os.path.join(cache_folder, f"{target}_{level}.npy")
-                    numpy.save(npy_path, frame)
+                    self.save_table(npy_path, frame)
                     remapping_table[target][level] = (
                         npy_path,
                         weight + 1
@@ -76,13 +104,13 @@ class TableManager:
                 frame_1, weight_1 = table[i][j-1]
                 frame_2, weight_2 = table[i][j]
                 if isinstance(frame_1, str):
-                    frame_1 = numpy.load(frame_1)
+                    frame_1 = self.load_table(frame_1)
                 if isinstance(frame_2, str):
-                    frame_2 = numpy.load(frame_2)
+                    frame_2 = self.load_table(frame_2)
                 frame = (frame_1 + frame_2) / 2
                 weight = weight_1 + weight_2
                 npy_path = os.path.join(cache_folder, f"{i}_{j}.npy")
-                numpy.save(npy_path, frame)
+                self.save_table(npy_path, frame)
                 table[i][j] = (npy_path, weight)
         return table
 
@@ -115,21 +143,21 @@ class TableManager:
                     frames_result.append(blending_table[target][level])
         for batch_id in tqdm(range(0, len(tasks), batch_size), desc=desc):
             tasks_batch = tasks[batch_id: min(batch_id + batch_size, len(tasks))]
-            source_guide = np.stack([np.array(Image.open(frames_guide[task["source"]].tolist())) for task in tasks_batch])
-            target_guide = np.stack([np.array(Image.open(frames_guide[task["target"]].tolist())) for task in tasks_batch])
-            source_style = np.stack([numpy.load(blending_table[task["source"]][task["level"]][0]) for task in tasks_batch])
+            source_guide = np.stack([self.load_image(frames_guide[task["source"]]) for task in tasks_batch])
+            target_guide = np.stack([self.load_image(frames_guide[task["target"]]) for task in tasks_batch])
+            source_style = np.stack([self.load_table(blending_table[task["source"]][task["level"]][0]) for task in tasks_batch])
             # source_style = np.stack([blending_table[task["source"]][task["level"]][0] for task in tasks_batch])
             _, target_style = patch_match_engine.estimate_nnf(source_guide, target_guide, source_style)
             for task, frame_2 in zip(tasks_batch, target_style):
                 source, target, level = task["source"], task["target"], task["level"]
                 frame_1, weight_1 = frames_result[target]
                 if isinstance(frame_1, str):
-                    frame_1 = numpy.load(frame_1)
+                    frame_1 = self.load_table(frame_1)
                 weight_2 = blending_table[source][level][1]
                 weight = weight_1 + weight_2
                 frame = frame_1 * (weight_1 / weight) + frame_2 * (weight_2 / weight)
                 nyp_path = os.path.join(cache_folder, f"result_{target}.npy")
-                numpy.save(nyp_path, frame)
+                self.save_table(nyp_path, frame)
                 frames_result[target] = (nyp_path, weight)
         return frames_result
 
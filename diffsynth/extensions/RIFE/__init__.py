@@ -4,6 +4,8 @@ import torch.nn as nn
 import torch.nn.functional as F
 from PIL import Image
 
+from ...data.video import load_frame
+
 
 def warp(tenInput, tenFlow, device):
     backwarp_tenGrid = {}
@@ -128,7 +130,7 @@ class RIFEInterpolater:
 
     def process_image(self, image):
         if isinstance(image, str):
-            image = Image.open(image)
+            image = load_frame(image)
         width, height = image.size
         if width % 32 != 0 or height % 32 != 0:
             width = (width + 31) // 32
@@ -195,7 +197,7 @@ class RIFEInterpolater:
         output_images = self.decode_images(processed_images)
         first_image = images[0]
         if isinstance(first_image, str):
-            first_image = Image.open(first_image)
+            first_image = load_frame(first_image)
         if output_images[0].size != first_image.size:
             output_images = [image.resize(first_image.size) for image in output_images]
         return output_images
@@ -5,6 +5,7 @@ from safetensors import safe_open
 
 from .sd_controlnet import SDControlNet
 from .sd_controlnet import SDControlNet
+from .attention import set_memory_budget
 from .sd_lora import SDLoRA
 from .sd_motion import SDMotionModel
 from .sd_motion import SDMotionModel
@@ -29,13 +30,20 @@ from .svd_vae_encoder import SVDVAEEncoder
 
 
 class ModelManager:
-    def __init__(self, torch_dtype=torch.float16, device="cuda"):
+    def __init__(self, torch_dtype=torch.float16, device="cuda", sequential_offload=False):
         self.torch_dtype = torch_dtype
         self.device = device
+        # The UNet, ControlNets and motion modules are kept in host memory, their blocks are streamed to the device (see WeightStreamer).
+        self.sequential_offload = sequential_offload
         self.model = {}
         self.model_path = {}
         self.textual_inversion_dict = {}
 
+    def component_device(self, component):
+        if self.sequential_offload and component in ["unet", "controlnet", "motion_modules"]:
+            return "cpu"
+        return self.device
+
     def is_stable_video_diffusion(self, state_dict):
         param_name = "model.diffusion_model.output_blocks.9.1.time_stack.0.norm_in.weight"
         return param_name in state_dict
@@ -122,7 +130,7 @@ class ModelManager:
                 if component == "vae_decoder":
                     self.model[component].to(torch.float32).to(self.device)
                 else:
-                    self.model[component].to(self.torch_dtype).to(self.device)
+                    self.model[component].to(self.torch_dtype).to(self.component_device(component))
 
             self.model_path[component] = file_path
 
@@ -155,7 +163,7 @@ class ModelManager:
             self.model_path[component] = []
         model = SDControlNet()
         model.load_state_dict(model.state_dict_converter().from_civitai(state_dict))
-        model.to(self.torch_dtype).to(self.device)
+        model.to(self.torch_dtype).to(self.component_device(component))
         self.model[component].append(model)
         self.model_path[component].append(file_path)
 
@@ -163,7 +171,7 @@ class ModelManager:
         component = "motion_modules"
         model = SDMotionModel()
         model.load_state_dict(model.state_dict_converter().from_civitai(state_dict))
-        model.to(self.torch_dtype).to(self.device)
+        model.to(self.torch_dtype).to(self.component_device(component))
         self.model[component] = model
         self.model_path[component] = file_path
 
@@ -196,7 +204,7 @@ class ModelManager:
 
     def load_sd_lora(self, state_dict, alpha):
         SDLoRA().add_lora_to_text_encoder(self.model["text_encoder"], state_dict, alpha=alpha, device=self.device)
-        SDLoRA().add_lora_to_unet(self.model["unet"], state_dict, alpha=alpha, device=self.device)
+        SDLoRA().add_lora_to_unet(self.model["unet"], state_dict, alpha=alpha, device=self.component_device("unet"))
 
     def load_translator(self, state_dict, file_path=""):
         # This model is lightweight, we do not place it on GPU.
@@ -270,6 +278,14 @@ class ModelManager:
                 self.model[component].to(device)
         torch.cuda.empty_cache()
 
+    def set_memory_budget(self, memory_budget):
+        # Chunked attention and feed-forward in every loaded model (UNets, VAEs, ControlNets, motion modules), see set_memory_budget
+        for component in self.model:
+            models = self.model[component] if isinstance(self.model[component], list) else [self.model[component]]
+            for model in models:
+                if isinstance(model, torch.nn.Module):
+                    set_memory_budget(model, memory_budget)
+
     def get_model_with_model_path(self, model_path):
         for component in self.model_path:
             if isinstance(self.model_path[component], str):
@@ -1,7 +1,80 @@
+import itertools
+from collections import OrderedDict
+
 import torch
 from einops import rearrange
 
 
+kv_cache_ids = itertools.count()
+
+
+def mark_kv_cacheable(tensor):
+    # The cross-attention K/V of this tensor (a prompt embedding) are computed once per Attention layer
+    # and reused until clear_kv_cache is called. The tensor must not be modified in place afterwards.
+    tensor.kv_cache_id = next(kv_cache_ids)
+    return tensor
+
+
+def clear_kv_cache(model):
+    for module in model.modules():
+        if isinstance(module, Attention):
+            module.kv_cache.clear()
+
+
+def set_memory_budget(model, memory_budget):
+    # Attention layers and feed-forward layers (GEGLU) of model work in chunks of at most memory_budget bytes
+    # of intermediate state. None turns chunking off.
+    for module in model.modules():
+        if hasattr(module, "memory_budget"):
+            module.memory_budget = memory_budget
+
+
+def chunked_attention(q, k, v, attn_mask=None, memory_budget=None):
+    # scaled_dot_product_attention over blocks of queries, the attention matrix of one block stays below memory_budget bytes.
+    # Backends without a fused kernel (CPU, older GPUs) materialize the whole matrix otherwise.
+    if memory_budget is None:
+        return torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask)
+    num_queries = q.shape[-2]
+    # float32 scores and softmax output for every query
+    bytes_per_query = q.shape[0] * q.shape[1] * k.shape[-2] * 4 * 2
+    chunk_size = max(1, memory_budget // bytes_per_query)
+    if chunk_size >= num_queries:
+        return torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask)
+    output = torch.empty(q.shape[:-1] + (v.shape[-1],), dtype=q.dtype, device=q.device)
+    for start in range(0, num_queries, chunk_size):
+        end = min(start + chunk_size, num_queries)
+        mask = attn_mask
+        if attn_mask is not None and attn_mask.dim() >= 2 and attn_mask.shape[-2] > 1:
+            mask = attn_mask[..., start: end, :]
+        output[..., start: end, :] = torch.nn.functional.scaled_dot_product_attention(q[..., start: end, :], k, v, attn_mask=mask)
+    return output
+
+
+def sparse_key_frames(num_frames, mode, num_keyframes=4, device=None):
+    # Frames each frame attends to in sparse cross-frame attention, besides itself. The cost grows linearly with num_frames.
+    #     "first_previous": the first frame and the previous frame
+    #     "anchor": the first frame only
+    #     "strided": num_keyframes frames spread evenly over the clip
+    # Returns (key_frame_ids, key_frame_mask), both (num_frames, keys). Repeated frames are masked out,
+    # so that they are not weighted twice in the softmax.
+    if mode == "first_previous":
+        key_frame_ids = [[i, 0, max(i - 1, 0)] for i in range(num_frames)]
+    elif mode == "anchor":
+        key_frame_ids = [[i, 0] for i in range(num_frames)]
+    elif mode == "strided":
+        num_keyframes = min(num_keyframes, num_frames)
+        keyframes = sorted(set(round(i * (num_frames - 1) / max(num_keyframes - 1, 1)) for i in range(num_keyframes)))
+        key_frame_ids = [[i] + keyframes for i in range(num_frames)]
+    else:
+        raise ValueError(f"Unknown cross_frame_attention mode: {mode}")
+    key_frame_mask = [[frame_id not in frame_ids[:j] for j, frame_id in enumerate(frame_ids)] for frame_ids in key_frame_ids]
+    key_frame_ids = torch.tensor(key_frame_ids, dtype=torch.long, device=device)
+    key_frame_mask = torch.tensor(key_frame_mask, dtype=torch.bool, device=device)
+    if key_frame_mask.all():
+        key_frame_mask = None
+    return key_frame_ids, key_frame_mask
+
+
 def low_version_attention(query, key, value, attn_bias=None):
     scale = 1 / query.shape[-1] ** 0.5
     query = query * scale
@@ -26,27 +99,85 @@ class Attention(torch.nn.Module):
         self.to_v = torch.nn.Linear(kv_dim, dim_inner, bias=bias_kv)
         self.to_out = torch.nn.Linear(dim_inner, q_dim, bias=bias_out)
 
+        self.kv_cache = OrderedDict()
+        self.max_kv_cache_entries = 8
+        # bytes, see set_memory_budget
+        self.memory_budget = None
+
+    def project_kv(self, encoder_hidden_states):
+        cache_id = getattr(encoder_hidden_states, "kv_cache_id", None)
+        if cache_id is not None and cache_id in self.kv_cache:
+            k, v = self.kv_cache[cache_id]
+            if k.device == encoder_hidden_states.device:
+                return k, v
+        k = self.to_k(encoder_hidden_states)
+        v = self.to_v(encoder_hidden_states)
+        if cache_id is not None:
+            self.kv_cache[cache_id] = (k, v)
+            while len(self.kv_cache) > self.max_kv_cache_entries:
+                self.kv_cache.popitem(last=False)
+        return k, v
+
     def torch_forward(self, hidden_states, encoder_hidden_states=None, attn_mask=None):
         if encoder_hidden_states is None:
             encoder_hidden_states = hidden_states
 
-        batch_size = encoder_hidden_states.shape[0]
+        batch_size = hidden_states.shape[0]
 
         q = self.to_q(hidden_states)
-        k = self.to_k(encoder_hidden_states)
-        v = self.to_v(encoder_hidden_states)
+        k, v = self.project_kv(encoder_hidden_states)
 
         q = q.view(batch_size, -1, self.num_heads, self.head_dim).transpose(1, 2)
-        k = k.view(batch_size, -1, self.num_heads, self.head_dim).transpose(1, 2)
-        v = v.view(batch_size, -1, self.num_heads, self.head_dim).transpose(1, 2)
-
-        hidden_states = torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask)
+        k = k.view(k.shape[0], -1, self.num_heads, self.head_dim).transpose(1, 2)
+        v = v.view(v.shape[0], -1, self.num_heads, self.head_dim).transpose(1, 2)
+
+        if k.shape[0] != batch_size:
+            # One encoder state per segment of rows (usually a single prompt for all frames), broadcast instead of repeated.
+            segments = k.shape[0]
+            rows = batch_size // segments
+            hidden_states = torch.concat([
+                chunked_attention(
+                    q[i * rows: (i + 1) * rows],
+                    k[i: i + 1].expand(rows, -1, -1, -1),
+                    v[i: i + 1].expand(rows, -1, -1, -1),
+                    attn_mask=attn_mask,
+                    memory_budget=self.memory_budget
+                )
+                for i in range(segments)
+            ], dim=0)
+        else:
+            hidden_states = chunked_attention(q, k, v, attn_mask=attn_mask, memory_budget=self.memory_budget)
         hidden_states = hidden_states.transpose(1, 2).reshape(batch_size, -1, self.num_heads * self.head_dim)
         hidden_states = hidden_states.to(q.dtype)
 
         hidden_states = self.to_out(hidden_states)
 
         return hidden_states
+
+    def sparse_frame_forward(self, hidden_states, key_frame_ids, key_frame_mask=None):
+        # Self-attention of a batch of frames, frame i attends to the tokens of the frames key_frame_ids[i] (see sparse_key_frames).
+        # K/V are projected once per frame and gathered for every frame that uses them.
+        num_frames, num_tokens = hidden_states.shape[:2]
+        num_keys = key_frame_ids.shape[1]
+
+        q = self.to_q(hidden_states)
+        k = self.to_k(hidden_states)
+        v = self.to_v(hidden_states)
+
+        q = q.view(num_frames, num_tokens, self.num_heads, self.head_dim).transpose(1, 2)
+        k = k[key_frame_ids].view(num_frames, num_keys * num_tokens, self.num_heads, self.head_dim).transpose(1, 2)
+        v = v[key_frame_ids].view(num_frames, num_keys * num_tokens, self.num_heads, self.head_dim).transpose(1, 2)
+
+        attn_mask = None
+        if key_frame_mask is not None:
+            attn_mask = key_frame_mask.repeat_interleave(num_tokens, dim=1)[:, None, None, :]
+        hidden_states = chunked_attention(q, k, v, attn_mask=attn_mask, memory_budget=self.memory_budget)
+        hidden_states = hidden_states.transpose(1, 2).reshape(num_frames, num_tokens, self.num_heads * self.head_dim)
+        hidden_states = hidden_states.to(q.dtype)
+
+        hidden_states = self.to_out(hidden_states)
+
+        return hidden_states
     
     def xformers_forward(self, hidden_states, encoder_hidden_states=None, attn_mask=None):
         if encoder_hidden_states is None:
@@ -0,0 +1,189 @@
+import torch
+
+
+class OffloadedTensor:
+    # A tensor that was moved to host memory by ActivationOffloader, see fetch.
+    def __init__(self, host_tensor, device, copied=None):
+        self.host_tensor = host_tensor
+        self.device = device
+        # CUDA events: device -> host copy finished, host -> device copy finished
+        self.copied = copied
+        self.device_tensor = None
+        self.loaded = None
+
+
+class ActivationOffloader:
+    # Moves activations (the res_stack of the UNet) to host memory and back while compute keeps running.
+    # Copies run on a separate CUDA stream into pinned buffers that are reused, prefetch starts bringing a tensor back early.
+    # Without CUDA nothing is copied, the calls only do the bookkeeping.
+
+    def __init__(self, device="cuda"):
+        self.device = torch.device(device)
+        self.use_cuda = self.device.type == "cuda" and torch.cuda.is_available()
+        self.copy_stream = torch.cuda.Stream(device=self.device) if self.use_cuda else None
+        # (shape, dtype) -> [(pinned buffer, event after which it is free)]
+        self.pool = {}
+        self.num_offloaded = 0
+        self.num_prefetched = 0
+        self.num_fetched = 0
+        self.num_allocated = 0
+
+    def pinned_buffer(self, shape, dtype):
+        buffers = self.pool.get((tuple(shape), dtype), [])
+        if len(buffers) > 0:
+            buffer, released = buffers.pop()
+            if released is not None:
+                released.synchronize()
+            return buffer
+        self.num_allocated += 1
+        return torch.empty(shape, dtype=dtype, pin_memory=self.use_cuda)
+
+    def release(self, buffer, released=None):
+        self.pool.setdefault((tuple(buffer.shape), buffer.dtype), []).append((buffer, released))
+
+    def offload(self, tensor):
+        self.num_offloaded += 1
+        if not self.use_cuda:
+            return OffloadedTensor(tensor, tensor.device)
+        buffer = self.pinned_buffer(tensor.shape, tensor.dtype)
+        self.copy_stream.wait_stream(torch.cuda.current_stream(self.device))
+        with torch.cuda.stream(self.copy_stream):
+            buffer.copy_(tensor, non_blocking=True)
+            copied = torch.cuda.Event()
+            copied.record(self.copy_stream)
+        # The allocator must not hand out the memory of tensor before the copy has read it.
+        tensor.record_stream(self.copy_stream)
+        return OffloadedTensor(buffer, tensor.device, copied=copied)
+
+    def prefetch(self, offloaded):
+        # Start the copy back to the device, fetch waits for it.
+        if not isinstance(offloaded, OffloadedTensor) or offloaded.device_tensor is not None:
+            return
+        self.num_prefetched += 1
+        if not self.use_cuda:
+            offloaded.device_tensor = offloaded.host_tensor
+            return
+        with torch.cuda.stream(self.copy_stream):
+            self.copy_stream.wait_event(offloaded.copied)
+            device_tensor = torch.empty(offloaded.host_tensor.shape, dtype=offloaded.host_tensor.dtype, device=offloaded.device)
+            device_tensor.copy_(offloaded.host_tensor, non_blocking=True)
+            offloaded.loaded = torch.cuda.Event()
+            offloaded.loaded.record(self.copy_stream)
+        offloaded.device_tensor = device_tensor
+
+    def fetch(self, offloaded):
+        # Returns the tensor on the device. Plain tensors are returned as they are.
+        if not isinstance(offloaded, OffloadedTensor):
+            return offloaded
+        self.num_fetched += 1
+        self.prefetch(offloaded)
+        tensor = offloaded.device_tensor
+        if self.use_cuda:
+            torch.cuda.current_stream(self.device).wait_event(offloaded.loaded)
+            # Allocated on the copy stream, used on the compute stream from now on.
+            tensor.record_stream(torch.cuda.current_stream(self.device))
+            self.release(offloaded.host_tensor, offloaded.loaded)
+        offloaded.device_tensor, offloaded.host_tensor = None, None
+        return tensor
+
+
+class WeightStreamer:
+    # Sequential offload (vram_limit_level=2): the weights of large units (UNet blocks, motion modules, ControlNets) stay in
+    # host memory and only the unit that is running, plus the one prefetched after it, is on the device.
+    # Loading copies the host weights on a separate CUDA stream, evicting only drops the device copies.
+    # On a CPU "device" the device copies are clones, a separate tensor pool whose size is tracked in resident_bytes.
+
+    def __init__(self, device="cuda"):
+        self.device = torch.device(device)
+        self.use_cuda = self.device.type == "cuda" and torch.cuda.is_available()
+        self.copy_stream = torch.cuda.Stream(device=self.device) if self.use_cuda else None
+        # id(unit) -> [(module, name, is_parameter, host tensor)]
+        self.units = {}
+        # id(unit) -> (device tensors, event)
+        self.loading = {}
+        self.resident = {}
+        self.resident_bytes = 0
+        self.peak_resident_bytes = 0
+
+    def attach(self, model, units):
+        # The weights of units are streamed, everything else in model is moved to the device once.
+        streamed = set()
+        for unit in units:
+            self.add_unit(unit)
+            streamed.update(id(tensor) for _, _, _, tensor in self.units.get(id(unit), []))
+        for module in model.modules():
+            for name, is_parameter, tensor in self.module_tensors(module):
+                if id(tensor) not in streamed:
+                    self.set_tensor(module, name, is_parameter, tensor.to(self.device))
+
+    def module_tensors(self, module):
+        for name, tensor in module._parameters.items():
+            if tensor is not None:
+                yield name, True, tensor
+        for name, tensor in module._buffers.items():
+            if tensor is not None:
+                yield name, False, tensor
+
+    def set_tensor(self, module, name, is_parameter, tensor):
+        if is_parameter:
+            module._parameters[name].data = tensor
+        else:
+            module._buffers[name] = tensor
+
+    def add_unit(self, unit):
+        entries = []
+        for module in unit.modules():
+            for name, is_parameter, tensor in list(self.module_tensors(module)):
+                host_tensor = tensor.detach().to("cpu")
+                if self.use_cuda:
+                    host_tensor = host_tensor.pin_memory()
+                self.set_tensor(module, name, is_parameter, host_tensor)
+                entries.append((module, name, is_parameter, module._parameters[name] if is_parameter else host_tensor))
+        if len(entries) > 0:
+            self.units[id(unit)] = entries
+
+    def prefetch(self, unit):
+        # Start copying the weights of unit to the device, load waits for them.
+        key = id(unit)
+        if unit is None or key not in self.units or key in self.loading or key in self.resident:
+            return
+        entries = self.units[key]
+        if self.use_cuda:
+            with torch.cuda.stream(self.copy_stream):
+                device_tensors = [tensor.data.to(self.device, non_blocking=True) for _, _, _, tensor in entries]
+                event = torch.cuda.Event()
+                event.record(self.copy_stream)
+        else:
+            device_tensors = [tensor.data.clone() for _, _, _, tensor in entries]
+            event = None
+        self.loading[key] = (device_tensors, event)
+
+    def load(self, unit):
+        # Make sure the weights of unit are on the device.
+        key = id(unit)
+        if unit is None or key not in self.units or key in self.resident:
+            return
+        self.prefetch(unit)
+        device_tensors, event = self.loading.pop(key)
+        if event is not None:
+            torch.cuda.current_stream(self.device).wait_event(event)
+        host_tensors = []
+        for (module, name, is_parameter, tensor), device_tensor in zip(self.units[key], device_tensors):
+            if self.use_cuda:
+                # Allocated on the copy stream, used on the compute stream.
+                device_tensor.record_stream(torch.cuda.current_stream(self.device))
+            host_tensors.append(tensor.data)
+            self.set_tensor(module, name, is_parameter, device_tensor)
+            self.resident_bytes += device_tensor.numel() * device_tensor.element_size()
+        self.resident[key] = host_tensors
+        self.peak_resident_bytes = max(self.peak_resident_bytes, self.resident_bytes)
+
+    def evict(self, unit):
+        key = id(unit)
+        if unit is None or key not in self.resident:
+            return
+        host_tensors = self.resident.pop(key)
+        for (module, name, is_parameter, tensor), host_tensor in zip(self.units[key], host_tensors):
+            device_tensor = module._parameters[name].data if is_parameter else module._buffers[name]
+            self.resident_bytes -= device_tensor.numel() * device_tensor.element_size()
+            self.set_tensor(module, name, is_parameter, host_tensor)
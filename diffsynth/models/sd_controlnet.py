@@ -93,6 +93,10 @@ class SDControlNet(torch.nn.Module):
 
         self.global_pool = global_pool
 
+    def embed_conditioning(self, conditioning):
+        # Only depends on the conditioning image, not on the timestep, so it can be computed once per frame and cached.
+        return self.controlnet_conv_in(conditioning)
+
     def forward(
         self,
         sample, timestep, encoder_hidden_states, conditioning,
@@ -101,11 +105,14 @@ class SDControlNet(torch.nn.Module):
         # 1. time
         time_emb = self.time_proj(timestep[None]).to(sample.dtype)
         time_emb = self.time_embedding(time_emb)
-        time_emb = time_emb.repeat(sample.shape[0], 1)
+        # Same timestep for every frame, broadcast in the ResnetBlocks instead of repeated.
 
         # 2. pre-process
         height, width = sample.shape[2], sample.shape[3]
-        hidden_states = self.conv_in(sample) + self.controlnet_conv_in(conditioning)
+        # conditioning is either the image (3 channels) or the output of embed_conditioning (320 channels)
+        if conditioning.shape[1] == 3:
+            conditioning = self.embed_conditioning(conditioning)
+        hidden_states = self.conv_in(sample) + conditioning
         text_emb = encoder_hidden_states
         res_stack = [hidden_states]
 
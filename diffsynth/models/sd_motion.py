@@ -1,4 +1,4 @@
-from .sd_unet import SDUNet, Attention, GEGLU
+from .sd_unet import SDUNet, Attention, GEGLU, feed_forward
 import torch
 from einops import rearrange, repeat
 
@@ -42,8 +42,7 @@ class TemporalTransformerBlock(torch.nn.Module):
 
         # 3. Feed-forward
         norm_hidden_states = self.norm3(hidden_states)
-        ff_output = self.act_fn(norm_hidden_states)
-        ff_output = self.ff(ff_output)
+        ff_output = feed_forward(self.act_fn, self.ff, norm_hidden_states)
         hidden_states = ff_output + hidden_states
 
         return hidden_states
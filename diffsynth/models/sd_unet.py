@@ -1,6 +1,7 @@
 import torch, math
-from .attention import Attention
+from .attention import Attention, sparse_key_frames
 from .tiler import TileWorker
+from .tome import TokenMerge
 
 
 class Timesteps(torch.nn.Module):
@@ -22,12 +23,29 @@ class GEGLU(torch.nn.Module):
     def __init__(self, dim_in, dim_out):
         super().__init__()
         self.proj = torch.nn.Linear(dim_in, dim_out * 2)
+        # bytes, see feed_forward and set_memory_budget
+        self.memory_budget = None
 
     def forward(self, hidden_states):
         hidden_states, gate = self.proj(hidden_states).chunk(2, dim=-1)
         return hidden_states * torch.nn.functional.gelu(gate)
 
 
+def feed_forward(act_fn, ff, hidden_states):
+    # GEGLU followed by the output Linear. With act_fn.memory_budget the tokens are processed in chunks,
+    # the wide hidden state (8x before the gate, 4x after it) only exists for one chunk at a time.
+    if act_fn.memory_budget is None:
+        return ff(act_fn(hidden_states))
+    shape = hidden_states.shape
+    hidden_states = hidden_states.reshape(-1, shape[-1])
+    bytes_per_token = act_fn.proj.out_features * 2 * hidden_states.element_size()
+    chunk_size = max(1, act_fn.memory_budget // bytes_per_token)
+    output = hidden_states.new_empty((hidden_states.shape[0], ff.out_features))
+    for start in range(0, hidden_states.shape[0], chunk_size):
+        output[start: start + chunk_size] = ff(act_fn(hidden_states[start: start + chunk_size]))
+    return output.reshape(shape[:-1] + (ff.out_features,))
+
+
 class BasicTransformerBlock(torch.nn.Module):
 
     def __init__(self, dim, num_attention_heads, attention_head_dim, cross_attention_dim):
@@ -47,10 +65,20 @@ class BasicTransformerBlock(torch.nn.Module):
         self.ff = torch.nn.Linear(dim * 4, dim)
 
 
-    def forward(self, hidden_states, encoder_hidden_states):
+    def forward(self, hidden_states, encoder_hidden_states, token_merge=None, key_frames=None):
+        # key_frames: sparse cross-frame attention, see sparse_key_frames
         # 1. Self-Attention
         norm_hidden_states = self.norm1(hidden_states)
-        attn_output = self.attn1(norm_hidden_states, encoder_hidden_states=None,)
+        if token_merge is not None:
+            # Fewer tokens in attn1, see TokenMerge
+            merge, unmerge = token_merge(norm_hidden_states)
+            norm_hidden_states = merge(norm_hidden_states)
+        if key_frames is not None:
+            attn_output = self.attn1.sparse_frame_forward(norm_hidden_states, *key_frames)
+        else:
+            attn_output = self.attn1(norm_hidden_states, encoder_hidden_states=None,)
+        if token_merge is not None:
+            attn_output = unmerge(attn_output)
         hidden_states = attn_output + hidden_states
 
         # 2. Cross-Attention
@@ -60,8 +88,7 @@ class BasicTransformerBlock(torch.nn.Module):
 
         # 3. Feed-forward
         norm_hidden_states = self.norm3(hidden_states)
-        ff_output = self.act_fn(norm_hidden_states)
-        ff_output = self.ff(ff_output)
+        ff_output = feed_forward(self.act_fn, self.ff, norm_hidden_states)
         hidden_states = ff_output + hidden_states
 
         return hidden_states
@@ -150,9 +177,17 @@ class AttentionBlock(torch.nn.Module):
         hidden_states, time_emb, text_emb, res_stack,
         cross_frame_attention=False,
         tiled=False, tile_size=64, tile_stride=32,
+        token_merge_ratio=0.0,
         **kwargs
     ):
+        # cross_frame_attention: True (or "full") attends to all frames of the batch as one sequence,
+        #     "first_previous", "anchor" and "strided" only to a few frames, see sparse_key_frames.
+        # token_merge_ratio: fraction of the tokens of every frame merged in self-attention (not with tiled)
         batch, _, height, width = hidden_states.shape
+        full_cross_frame_attention = cross_frame_attention is True or cross_frame_attention == "full"
+        key_frames = None
+        if cross_frame_attention and not full_cross_frame_attention:
+            key_frames = sparse_key_frames(batch, cross_frame_attention, device=hidden_states.device)
         residual = hidden_states
 
         hidden_states = self.norm(hidden_states)
@@ -160,13 +195,12 @@ class AttentionBlock(torch.nn.Module):
         hidden_states = hidden_states.permute(0, 2, 3, 1).reshape(batch, height * width, inner_dim)
         hidden_states = self.proj_in(hidden_states)
 
-        if cross_frame_attention:
+        if full_cross_frame_attention:
             hidden_states = hidden_states.reshape(1, batch * height * width, inner_dim)
-            encoder_hidden_states = text_emb.mean(dim=0, keepdim=True)
+            encoder_hidden_states = text_emb if text_emb.shape[0] == 1 else text_emb.mean(dim=0, keepdim=True)
         else:
+            # A single text embedding is broadcast to all frames in Attention, not repeated here.
             encoder_hidden_states = text_emb
-            if encoder_hidden_states.shape[0] != hidden_states.shape[0]:
-                encoder_hidden_states = encoder_hidden_states.repeat(hidden_states.shape[0], 1, 1)
 
         if tiled:
             tile_size = min(tile_size, min(height, width))
@@ -174,7 +208,7 @@ class AttentionBlock(torch.nn.Module):
             def block_tile_forward(x):
                 b, c, h, w = x.shape
                 x = x.permute(0, 2, 3, 1).reshape(b, h*w, c)
-                x = block(x, encoder_hidden_states)
+                x = block(x, encoder_hidden_states, key_frames=key_frames)
                 x = x.reshape(b, h, w, c).permute(0, 3, 1, 2)
                 return x
             for block in self.transformer_blocks:
@@ -188,12 +222,15 @@ class AttentionBlock(torch.nn.Module):
                 )
             hidden_states = hidden_states.permute(0, 2, 3, 1).reshape(batch, height * width, inner_dim)
         else:
+            token_merge = TokenMerge(token_merge_ratio, batch, height, width) if token_merge_ratio > 0 else None
             for block in self.transformer_blocks:
                 hidden_states = block(
                     hidden_states,
-                    encoder_hidden_states=encoder_hidden_states
+                    encoder_hidden_states=encoder_hidden_states,
+                    token_merge=token_merge,
+                    key_frames=key_frames
                 )
-        if cross_frame_attention:
+        if full_cross_frame_attention:
             hidden_states = hidden_states.reshape(batch, height * width, inner_dim)
 
         if self.need_proj_out:
@@ -1,6 +1,6 @@
 import torch, math
 from einops import rearrange, repeat
-from .sd_unet import Timesteps, PushBlock, PopBlock, Attention, GEGLU, ResnetBlock, AttentionBlock, DownSampler, UpSampler
+from .sd_unet import Timesteps, PushBlock, PopBlock, Attention, GEGLU, feed_forward, ResnetBlock, AttentionBlock, DownSampler, UpSampler
 
 
 class TemporalResnetBlock(torch.nn.Module):
@@ -148,8 +148,7 @@ class TemporalAttentionBlock(torch.nn.Module):
 
         residual = hidden_states
         hidden_states = self.norm_in(hidden_states)
-        hidden_states = self.act_fn_in(hidden_states)
-        hidden_states = self.ff_in(hidden_states)
+        hidden_states = feed_forward(self.act_fn_in, self.ff_in, hidden_states)
         hidden_states = hidden_states + residual
 
         norm_hidden_states = self.norm1(hidden_states)
@@ -162,8 +161,7 @@ class TemporalAttentionBlock(torch.nn.Module):
 
         residual = hidden_states
         hidden_states = self.norm_out(hidden_states)
-        hidden_states = self.act_fn_out(hidden_states)
-        hidden_states = self.ff_out(hidden_states)
+        hidden_states = feed_forward(self.act_fn_out, self.ff_out, hidden_states)
         hidden_states = hidden_states + residual
 
         hidden_states = hidden_states.reshape(height, width, batch, inner_dim).permute(2, 3, 0, 1)
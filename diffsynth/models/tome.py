@@ -0,0 +1,72 @@
+import torch
+
+
+class TokenMerge:
+    # Token merging (ToMe for Stable Diffusion) for the self-attention of BasicTransformerBlock.
+    # The frame is split into stride x stride cells, the top-left token of every cell is a destination, the other tokens
+    # are sources. The ratio * tokens sources most similar to a destination are averaged into it before attn1,
+    # afterwards every merged source gets the output of its destination back.
+    # The destinations are fixed instead of random, so that neighbouring frames and timesteps merge alike.
+    # Frames are matched separately, also with cross_frame_attention where all frames of a batch are one sequence.
+
+    def __init__(self, ratio, num_frames, height, width, stride=2):
+        self.ratio = ratio
+        self.num_frames = num_frames
+        self.height = height
+        self.width = width
+        self.stride = stride
+
+    def partition(self, device):
+        # Token ids of the destinations and of the sources
+        cells_h, cells_w = self.height // self.stride, self.width // self.stride
+        is_source = torch.ones((self.height, self.width), dtype=torch.bool, device=device)
+        is_source[:cells_h * self.stride: self.stride, :cells_w * self.stride: self.stride] = False
+        is_source = is_source.flatten()
+        token_ids = torch.arange(self.height * self.width, device=device)
+        return token_ids[~is_source], token_ids[is_source]
+
+    def __call__(self, metric):
+        # metric: the tokens going into attn1, (frames, tokens, dim) or (1, frames * tokens, dim)
+        # Returns (merge, unmerge)
+        shape = metric.shape
+        num_tokens = self.height * self.width
+        dst_ids, src_ids = self.partition(metric.device)
+        num_merged = min(int(num_tokens * self.ratio), src_ids.shape[0])
+        if num_merged <= 0 or shape[0] * shape[1] != self.num_frames * num_tokens:
+            return (lambda x: x), (lambda x: x)
+
+        with torch.no_grad():
+            metric = metric.reshape(self.num_frames, num_tokens, shape[-1])
+            metric = metric / metric.norm(dim=-1, keepdim=True)
+            scores = metric[:, src_ids] @ metric[:, dst_ids].transpose(-1, -2)
+            node_max, node_idx = scores.max(dim=-1)
+            edge_idx = node_max.argsort(dim=-1, descending=True)[..., None]
+            # Sources that are kept, sources that are merged, and the destinations they are merged into
+            unm_idx = edge_idx[:, num_merged:]
+            src_idx = edge_idx[:, :num_merged]
+            dst_idx = node_idx[..., None].gather(dim=1, index=src_idx)
+            num_kept = unm_idx.shape[1]
+
+        def merge(x):
+            channels = x.shape[-1]
+            x = x.reshape(self.num_frames, num_tokens, channels)
+            src, dst = x[:, src_ids], x[:, dst_ids]
+            unm = src.gather(dim=1, index=unm_idx.expand(-1, -1, channels))
+            src = src.gather(dim=1, index=src_idx.expand(-1, -1, channels))
+            dst = dst.scatter_reduce(1, dst_idx.expand(-1, -1, channels), src, reduce="mean")
+            x = torch.concat([unm, dst], dim=1)
+            return x.reshape(shape[0], -1, channels)
+
+        def unmerge(x):
+            channels = x.shape[-1]
+            x = x.reshape(self.num_frames, -1, channels)
+            unm, dst = x[:, :num_kept], x[:, num_kept:]
+            src = dst.gather(dim=1, index=dst_idx.expand(-1, -1, channels))
+            out = torch.empty((self.num_frames, num_tokens, channels), dtype=x.dtype, device=x.device)
+            out[:, dst_ids] = dst
+            frame_src_ids = src_ids.expand(self.num_frames, -1)[..., None]
+            out.scatter_(1, frame_src_ids.gather(dim=1, index=unm_idx).expand(-1, -1, channels), unm)
+            out.scatter_(1, frame_src_ids.gather(dim=1, index=src_idx).expand(-1, -1, channels), src)
+            return out.reshape(shape[0], num_tokens * self.num_frames // shape[0], channels)
+
+        return merge, unmerge
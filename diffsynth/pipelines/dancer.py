@@ -1,9 +1,91 @@
 import torch
+from ..models.attention import mark_kv_cacheable
+from ..models.offload import ActivationOffloader
 from ..models import SDUNet, SDMotionModel, SDXLUNet, SDXLMotionModel
 from ..models.sd_unet import PushBlock, PopBlock
 from ..controlnets import MultiControlNetManager
 
 
+def clip_batches(num_rows, num_frames, batch_size):
+    # Slices of at most batch_size rows that never cross the border of two clips (e.g. the two CFG branches),
+    # so that cross-frame attention and ControlNet frames stay inside one clip.
+    for clip_start in range(0, num_rows, num_frames):
+        for batch_id in range(clip_start, clip_start + num_frames, batch_size):
+            yield clip_start, batch_id, min(batch_id + batch_size, clip_start + num_frames)
+
+
+def shared_text_emb(text_emb, device=None):
+    # One prompt for all frames, given either with batch size 1 or as prompt_emb.expand(num_frames, ...).
+    # An expanded embedding is reduced to its single row, so it is never materialized per frame or copied per window.
+    if text_emb.shape[0] > 1 and text_emb.stride(0) == 0:
+        text_emb = mark_kv_cacheable(text_emb[:1].clone())
+    if text_emb.shape[0] == 1 and device is not None:
+        kv_cache_id = getattr(text_emb, "kv_cache_id", None)
+        text_emb = text_emb.to(device)
+        if kv_cache_id is not None:
+            text_emb.kv_cache_id = kv_cache_id
+    return text_emb
+
+
+def select_text_emb(encoder_hidden_states, num_frames, clip_start, batch_id, batch_id_):
+    # encoder_hidden_states can be
+    #     a list with one embedding per clip, e.g. [positive, negative] when both CFG branches are batched,
+    #     or the embedding of every clip.
+    # An embedding has a single row shared by all frames (broadcast in Attention and its K/V cached),
+    # one row per segment of num_frames // rows consecutive frames, or one row per frame.
+    # Rows of several clips concatenated (one row per row of sample) are also accepted without a list.
+    if isinstance(encoder_hidden_states, (list, tuple)):
+        encoder_hidden_states = encoder_hidden_states[clip_start // num_frames]
+    elif encoder_hidden_states.shape[0] > num_frames:
+        return encoder_hidden_states[batch_id: batch_id_]
+    return select_clip_rows(encoder_hidden_states, num_frames, batch_id - clip_start, batch_id_ - clip_start)
+
+
+def select_clip_rows(text_emb, num_frames, start, end):
+    # Rows of text_emb for the frames range(start, end) of a clip, see select_text_emb.
+    # Attention broadcasts every row over batch_size // rows frames, so segments are only passed through
+    # if each of them covers the same number of frames, otherwise one row per frame is selected.
+    num_segments = text_emb.shape[0]
+    if num_segments == 1:
+        return text_emb
+    if num_frames % num_segments != 0:
+        raise ValueError(f"{num_segments} prompt embeddings cannot be split evenly over {num_frames} frames")
+    segment_length = num_frames // num_segments
+    first, last = start // segment_length, (end - 1) // segment_length
+    if first == last:
+        return text_emb[first: first + 1]
+    if start % segment_length == 0 and end % segment_length == 0:
+        return text_emb[first: last + 1]
+    segment_ids = torch.arange(start, end, device=text_emb.device) // segment_length
+    return text_emb[segment_ids]
+
+
+def stream_units(unet, motion_modules=None, skipped_block_ids=()):
+    # UNet blocks and motion modules in the order lets_dance runs them.
+    units = []
+    for block_id, block in enumerate(unet.blocks):
+        if block_id in skipped_block_ids:
+            continue
+        units.append(block)
+        if motion_modules is not None and block_id in motion_modules.call_block_id:
+            units.append(motion_modules.motion_modules[motion_modules.call_block_id[block_id]])
+    return units
+
+
+def deep_cache_blocks(unet, depth=1):
+    # DeepCache: the blocks in range(deep_start, deep_end) (down to the bottleneck and back up) change little between
+    # neighbouring timesteps. Cheap steps skip them and continue with their output from the last full step.
+    # depth: number of skip connections (PushBlock) that are still computed on cheap steps, besides the output of conv_in.
+    #     0 only recomputes the last up block, 1 also the first ResnetBlock and AttentionBlock, ...
+    push_ids = [block_id for block_id, block in enumerate(unet.blocks) if isinstance(block, PushBlock)]
+    pop_ids = [block_id for block_id, block in enumerate(unet.blocks) if isinstance(block, PopBlock)]
+    if depth < 0 or depth > len(push_ids):
+        raise ValueError(f"deep_cache_depth must be between 0 and {len(push_ids)}, got {depth}")
+    deep_start = push_ids[depth - 1] + 1 if depth > 0 else 0
+    deep_end = pop_ids[len(pop_ids) - depth - 1]
+    return deep_start, deep_end
+
+
 def lets_dance(
     unet: SDUNet,
     motion_modules: SDMotionModel = None,
@@ -20,31 +102,84 @@ def lets_dance(
     tile_stride=32,
     device = "cuda",
     vram_limit_level = 0,
+    batch_size = 1,
+    offloader = None,
+    weight_streamer = None,
+    deep_cache_depth = 1,
+    deep_features = None,
+    return_deep_features = False,
+    token_merge_ratio = 0.0,
+    token_merge_max_downsample = 1,
 ):
+    # batch_size: number of clips concatenated in sample, all of them share controlnet_frames.
+    # encoder_hidden_states: see select_text_emb
+    # offloader: ActivationOffloader used with vram_limit_level >= 1, pass one in to reuse its pinned buffers across calls.
+    # weight_streamer: WeightStreamer (vram_limit_level=2), every block is loaded right before it runs and evicted afterwards.
+    # deep_features: returned by a full step with return_deep_features=True, the deep blocks (see deep_cache_blocks) and
+    #     the ControlNets are skipped and these features are used instead. The ControlNet residuals of the skip connections
+    #     that are still computed are part of them.
+    # return_deep_features: returns (output, deep_features)
+    # token_merge_ratio: ToMe in the self-attention of the AttentionBlocks whose resolution is at most
+    #     token_merge_max_downsample times lower than the latents (1: only the largest ones), see TokenMerge.
+    num_frames = sample.shape[0] // batch_size
+    if vram_limit_level >= 1 and offloader is None:
+        offloader = ActivationOffloader(device)
+    elif vram_limit_level < 1:
+        offloader = None
+    if isinstance(encoder_hidden_states, (list, tuple)):
+        encoder_hidden_states = [shared_text_emb(text_emb) for text_emb in encoder_hidden_states]
+    else:
+        encoder_hidden_states = shared_text_emb(encoder_hidden_states)
+
     # 1. ControlNet
     #     This part will be repeated on overlapping frames if animatediff_batch_size > animatediff_stride.
     #     I leave it here because I intend to do something interesting on the ControlNets.
     controlnet_insert_block_id = 30
-    if controlnet is not None and controlnet_frames is not None:
+    deep_start, deep_end = deep_cache_blocks(unet, deep_cache_depth) if deep_features is not None or return_deep_features else (0, 0)
+    skipped_block_ids = range(deep_start, deep_end) if deep_features is not None else ()
+    units = stream_units(unet, motion_modules, skipped_block_ids) if weight_streamer is not None else []
+    deep_hidden_states, deep_controlnet_res_stack = None, None
+    if controlnet is not None and controlnet_frames is not None and deep_features is None:
+        # With streamed weights, all batches run through one ControlNet before the next one is loaded.
+        processor_groups = [None] if weight_streamer is None else [[i] for i in range(len(controlnet.models))]
         res_stacks = []
-        # process controlnet frames with batch
-        for batch_id in range(0, sample.shape[0], controlnet_batch_size):
-            batch_id_ = min(batch_id + controlnet_batch_size, sample.shape[0])
-            res_stack = controlnet(
-                sample[batch_id: batch_id_],
-                timestep,
-                encoder_hidden_states[batch_id: batch_id_],
-                controlnet_frames[:, batch_id: batch_id_],
-                tiled=tiled, tile_size=tile_size, tile_stride=tile_stride
-            )
-            if vram_limit_level >= 1:
-                res_stack = [res.cpu() for res in res_stack]
-            res_stacks.append(res_stack)
-        # concat the residual
+        for group_id, processor_ids in enumerate(processor_groups):
+            if weight_streamer is not None:
+                weight_streamer.load(controlnet.models[processor_ids[0]])
+                next_unit = controlnet.models[processor_groups[group_id + 1][0]] if group_id + 1 < len(processor_groups) else units[0]
+                weight_streamer.prefetch(next_unit)
+            # process controlnet frames with batch
+            for batch_index, (clip_start, batch_id, batch_id_) in enumerate(clip_batches(sample.shape[0], num_frames, controlnet_batch_size)):
+                res_stack = controlnet(
+                    sample[batch_id: batch_id_],
+                    timestep,
+                    select_text_emb(encoder_hidden_states, num_frames, clip_start, batch_id, batch_id_),
+                    controlnet_frames[:, batch_id - clip_start: batch_id_ - clip_start],
+                    tiled=tiled, tile_size=tile_size, tile_stride=tile_stride,
+                    processor_ids=processor_ids
+                )
+                if group_id > 0:
+                    # add to the residuals of the previous ControlNets
+                    res_stack = [
+                        (offloader.fetch(res_) if offloader is not None else res_) + res
+                        for res_, res in zip(res_stacks[batch_index], res_stack)
+                    ]
+                if offloader is not None:
+                    res_stack = [offloader.offload(res) for res in res_stack]
+                if group_id == 0:
+                    res_stacks.append(res_stack)
+                else:
+                    res_stacks[batch_index] = res_stack
+            if weight_streamer is not None:
+                weight_streamer.evict(controlnet.models[processor_ids[0]])
+        # concat the residual (offloaded residuals are concatenated when they are used)
         additional_res_stack = []
         for i in range(len(res_stacks[0])):
-            res = torch.concat([res_stack[i] for res_stack in res_stacks], dim=0)
-            additional_res_stack.append(res)
+            if offloader is not None:
+                additional_res_stack.append([res_stack[i] for res_stack in res_stacks])
+            else:
+                res = torch.concat([res_stack[i] for res_stack in res_stacks], dim=0)
+                additional_res_stack.append(res)
     else:
         additional_res_stack = None
 
@@ -56,48 +191,101 @@ def lets_dance(
     height, width = sample.shape[2], sample.shape[3]
     hidden_states = unet.conv_in(sample)
     text_emb = encoder_hidden_states
-    res_stack = [hidden_states.cpu() if vram_limit_level>=1 else hidden_states]
+    res_stack = [offloader.offload(hidden_states) if offloader is not None else hidden_states]
+
+    def load_unit(unit):
+        # Load this unit, and start copying the next one with weights.
+        if weight_streamer is None:
+            return
+        weight_streamer.load(unit)
+        for next_unit in units[units.index(unit) + 1:]:
+            if id(next_unit) in weight_streamer.units:
+                weight_streamer.prefetch(next_unit)
+                break
 
     # 4. blocks
     for block_id, block in enumerate(unet.blocks):
+        if block_id in skipped_block_ids:
+            if block_id == deep_start:
+                # Continue with the deep features of the last full step
+                if deep_features["controlnet"] is not None:
+                    for i, additional_res in enumerate(deep_features["controlnet"]):
+                        res = (offloader.fetch(res_stack[i]) if offloader is not None else res_stack[i]) + additional_res
+                        res_stack[i] = offloader.offload(res) if offloader is not None else res
+                    if offloader is not None:
+                        offloader.prefetch(res_stack[-1])
+                hidden_states = deep_features["hidden_states"]
+            continue
+        if return_deep_features and block_id == deep_end:
+            deep_hidden_states = hidden_states
+        load_unit(block)
+        if offloader is not None and block_id == controlnet_insert_block_id and additional_res_stack is not None:
+            # Copied back while this block is running
+            for res in additional_res_stack[-1]:
+                offloader.prefetch(res)
         # 4.1 UNet
         if isinstance(block, PushBlock):
             hidden_states, time_emb, text_emb, res_stack = block(hidden_states, time_emb, text_emb, res_stack)
-            if vram_limit_level>=1:
-                res_stack[-1] = res_stack[-1].cpu()
+            if offloader is not None:
+                res_stack[-1] = offloader.offload(res_stack[-1])
         elif isinstance(block, PopBlock):
-            if vram_limit_level>=1:
-                res_stack[-1] = res_stack[-1].to(device)
+            if offloader is not None:
+                res_stack[-1] = offloader.fetch(res_stack[-1])
             hidden_states, time_emb, text_emb, res_stack = block(hidden_states, time_emb, text_emb, res_stack)
+            if offloader is not None and len(res_stack) > 0:
+                # The residual of the next PopBlock is copied back while the blocks in between are running.
+                offloader.prefetch(res_stack[-1])
         else:
             hidden_states_input = hidden_states
             hidden_states_output = []
-            for batch_id in range(0, sample.shape[0], unet_batch_size):
-                batch_id_ = min(batch_id + unet_batch_size, sample.shape[0])
+            block_token_merge_ratio = token_merge_ratio if height // hidden_states_input.shape[2] <= token_merge_max_downsample else 0.0
+            for clip_start, batch_id, batch_id_ in clip_batches(sample.shape[0], num_frames, unet_batch_size):
                 hidden_states, _, _, _ = block(
                     hidden_states_input[batch_id: batch_id_],
                     time_emb,
-                    text_emb[batch_id: batch_id_],
+                    select_text_emb(text_emb, num_frames, clip_start, batch_id, batch_id_),
                     res_stack,
                     cross_frame_attention=cross_frame_attention,
-                    tiled=tiled, tile_size=tile_size, tile_stride=tile_stride
+                    tiled=tiled, tile_size=tile_size, tile_stride=tile_stride,
+                    token_merge_ratio=block_token_merge_ratio
                 )
                 hidden_states_output.append(hidden_states)
             hidden_states = torch.concat(hidden_states_output, dim=0)
+        if weight_streamer is not None:
+            weight_streamer.evict(block)
         # 4.2 AnimateDiff
         if motion_modules is not None:
             if block_id in motion_modules.call_block_id:
                 motion_module_id = motion_modules.call_block_id[block_id]
+                load_unit(motion_modules.motion_modules[motion_module_id])
                 hidden_states, time_emb, text_emb, res_stack = motion_modules.motion_modules[motion_module_id](
                     hidden_states, time_emb, text_emb, res_stack,
-                    batch_size=1
+                    batch_size=batch_size
                 )
+                if weight_streamer is not None:
+                    weight_streamer.evict(motion_modules.motion_modules[motion_module_id])
         # 4.3 ControlNet
         if block_id == controlnet_insert_block_id and additional_res_stack is not None:
-            hidden_states += additional_res_stack.pop().to(device)
-            if vram_limit_level>=1:
-                res_stack = [(res.to(device) + additional_res.to(device)).cpu() for res, additional_res in zip(res_stack, additional_res_stack)]
+            if offloader is not None:
+                hidden_states += torch.concat([offloader.fetch(res) for res in additional_res_stack.pop()], dim=0)
+                # One residual at a time on the device, the next one is copied while this one is added.
+                merged_res_stack = []
+                for next_res in [res_stack[0]] + additional_res_stack[0]:
+                    offloader.prefetch(next_res)
+                for i, (res, additional_res) in enumerate(zip(res_stack, additional_res_stack)):
+                    for next_res in ([res_stack[i + 1]] + additional_res_stack[i + 1] if i + 1 < len(res_stack) else []):
+                        offloader.prefetch(next_res)
+                    additional_res = torch.concat([offloader.fetch(res_) for res_ in additional_res], dim=0)
+                    if return_deep_features and i <= deep_cache_depth:
+                        deep_controlnet_res_stack = (deep_controlnet_res_stack or []) + [additional_res]
+                    res = offloader.fetch(res) + additional_res
+                    merged_res_stack.append(offloader.offload(res))
+                res_stack = merged_res_stack
+                offloader.prefetch(res_stack[-1])
             else:
+                hidden_states += additional_res_stack.pop().to(device)
+                if return_deep_features:
+                    deep_controlnet_res_stack = additional_res_stack[:deep_cache_depth + 1]
                 res_stack = [res + additional_res for res, additional_res in zip(res_stack, additional_res_stack)]
     
     # 5. output
@@ -105,6 +293,8 @@ def lets_dance(
     hidden_states = unet.conv_act(hidden_states)
     hidden_states = unet.conv_out(hidden_states)
 
+    if return_deep_features:
+        return hidden_states, {"hidden_states": deep_hidden_states, "controlnet": deep_controlnet_res_stack}
     return hidden_states
 
 
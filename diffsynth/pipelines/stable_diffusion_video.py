@@ -2,6 +2,7 @@ import json
 import os
 import shutil
 import time
+from functools import partial
 from typing import List
 
 import numpy as np
@@ -9,15 +10,101 @@ import torch
 from PIL import Image
 from tqdm import tqdm
 
-from .dancer import lets_dance
+from .dancer import lets_dance, shared_text_emb
 from ..controlnets import MultiControlNetManager, ControlNetUnit, ControlNetConfigUnit, Annotator
-from ..data import VideoData, save_frames, save_video
+from ..data import VideoData, DiskCacheManager, TieredCache, MemmapTensorStore, BackgroundWriter, CacheManifest, config_hash, file_signature, save_frames, save_video
+from ..data.prefetch import WindowPrefetcher, sliding_windows, background_iter
+from ..data.video import save_frame, load_frame, load_frame_array, frame_file_name, FrameSequence, IncrementalVideoWriter
+from ..data.cache import parse_size
+from ..data.checkpoint import LatentCheckpoint
+from ..data.dedup import find_held_frames
 from ..models import ModelManager, SDTextEncoder, SDUNet, SDVAEDecoder, SDVAEEncoder, SDMotionModel
+from ..models.attention import mark_kv_cacheable, clear_kv_cache
+from ..models.offload import ActivationOffloader, WeightStreamer
 from ..processors.sequencial_processor import SequencialProcessor
 from ..prompts import SDPrompter
 from ..schedulers import EnhancedDDIMScheduler
 
 
+class DeepFeatureCache:
+    # Deep UNet features of every window (see lets_dance and deep_cache_blocks), computed on full steps and reused on cheap steps.
+    # With a folder, every tensor of every window is an .npy file in the "deep_cache" class of cache_manager,
+    # so config.data.cache_budgets limits the disk space (and a TieredCache keeps the hot windows in RAM).
+    # One tensor is (frames * branches, 320, height // 8, width // 8), about 40 MiB for a 16 frame window at 512x512
+    # and 150 MiB at 1280x768, plus one more per ControlNet residual that is kept (deep_cache_depth + 1 of them).
+    # An evicted window is not rebuilt, the next cheap step computes it fully instead.
+    # Only windows written by this run are reused, files left behind by a killed run are deleted when the next run starts.
+
+    def __init__(self, folder=None, cache_manager=None):
+        self.folder = folder
+        self.cache_manager = cache_manager
+        self.dtype = None
+        # (key, window_id) -> tensors without a folder, file paths with a folder
+        self.windows = {}
+        if folder is not None:
+            self.clear()
+            os.makedirs(folder, exist_ok=True)
+
+    def has(self, key, window_id):
+        if (key, window_id) not in self.windows:
+            return False
+        if self.folder is None:
+            return True
+        return not any(self.cache_manager.is_evicted(path) for path in self.windows[(key, window_id)])
+
+    def save(self, key, window_id, deep_features):
+        tensors = [deep_features["hidden_states"]] + (deep_features["controlnet"] or [])
+        self.dtype = tensors[0].dtype
+        if self.folder is None:
+            self.windows[(key, window_id)] = [tensor.cpu() for tensor in tensors]
+            return
+        paths = []
+        for tensor_id, tensor in enumerate(tensors):
+            path = os.path.join(self.folder, f"{key}_{window_id}_{tensor_id}.npy")
+            tensor = tensor.cpu()
+            if tensor.dtype == torch.bfloat16:
+                # numpy has no bfloat16
+                tensor = tensor.view(torch.int16)
+            self.cache_manager.write("deep_cache", path, self.write_array, tensor.numpy(), recompute_fn=partial(self.missing, path))
+            paths.append(path)
+        self.windows[(key, window_id)] = paths
+
+    def load(self, key, window_id, device):
+        # Returns None if the window was evicted in the meantime.
+        if self.folder is None:
+            tensors = [tensor.to(device) for tensor in self.windows[(key, window_id)]]
+        else:
+            tensors = []
+            try:
+                for path in self.windows[(key, window_id)]:
+                    tensor = torch.from_numpy(np.array(self.cache_manager.load(path, np.load)))
+                    if self.dtype == torch.bfloat16:
+                        tensor = tensor.view(torch.bfloat16)
+                    tensors.append(tensor.to(device))
+            except FileNotFoundError:
+                return None
+        return {"hidden_states": tensors[0], "controlnet": tensors[1:] if len(tensors) > 1 else None}
+
+    def write_array(self, path, array):
+        temp_path = path + ".tmp"
+        with open(temp_path, "wb") as f:
+            np.save(f, array)
+        os.replace(temp_path, path)
+
+    def missing(self, path):
+        # recompute_fn of the files: deep features cannot be rebuilt on their own, the window is computed fully instead.
+        raise FileNotFoundError(path)
+
+    def clear(self):
+        if self.folder is not None:
+            for paths in self.windows.values():
+                for path in paths:
+                    self.cache_manager.discard(path)
+            if os.path.exists(self.folder):
+                shutil.rmtree(self.folder)
+        self.windows = {}
+
+
 def lets_dance_with_long_video(
         unet: SDUNet,
         motion_modules: SDMotionModel = None,
@@ -25,76 +112,141 @@ def lets_dance_with_long_video(
         sample=None,
         timestep=None,
         encoder_hidden_states=None,
-        controlnet_processor_count=2,
+        negative_encoder_hidden_states=None,
+        controlnet_stores=None,
         animatediff_batch_size=16,
         animatediff_stride=8,
         unet_batch_size=1,
         controlnet_batch_size=1,
-        controlnet_cache_dir="controlnet_cache",
         cross_frame_attention=False,
         device="cuda",
         vram_limit_level=0,
+        resume_state=None,
+        save_state_fn=None,
+        checkpoint_seconds=0,
+        accumulator_path=None,
+        weight_streamer=None,
+        deep_cache=None,
+        deep_cache_key="posi",
+        deep_cache_reuse=False,
+        deep_cache_depth=1,
+        token_merge_ratio=0.0,
+        token_merge_max_downsample=1,
 ):
+    # With negative_encoder_hidden_states, both CFG branches of a window run through lets_dance as one batch,
+    # and a tuple (positive, negative) is returned.
+    # deep_cache: DeepFeatureCache, the deep features of every window are saved under deep_cache_key,
+    #     or reused if deep_cache_reuse is set (windows without saved features are computed fully).
+    # save_state_fn gets the accumulators themselves, not copies. It must be done with them when it returns.
     num_frames = sample.shape[0]
-    hidden_states_output = [(torch.zeros(sample[0].shape, dtype=sample[0].dtype), 0) for i in range(num_frames)]
-
-    controlnet_hold_cache = {}
-
-    for batch_id in tqdm(range(0, num_frames, animatediff_stride), leave=False, desc=f'dance_batch'):
-        batch_id_ = min(batch_id + animatediff_batch_size, num_frames)
-
-        stack_controlnet_file_contents = []
-        process_caches = []
-        controlnet_cache_frames = None
-
-        for processor_id in range(controlnet_processor_count):
-            controlnet_file_contents = []
-            for i in range(batch_id, batch_id_):
-                cache_path = controlnet_cache_dir + f'/cache_p{processor_id}_{i}.pt'
-                if cache_path in controlnet_hold_cache:
-                    load_data = controlnet_hold_cache[cache_path]
-                    # print(f'命中缓存{cache_path}')
-                else:
-                    load_data = torch.load(cache_path)[0]
-                    controlnet_hold_cache[cache_path] = load_data
-                    # print(f'加载缓存{cache_path}')
-                    if len(controlnet_hold_cache) > animatediff_batch_size * 2:
-                        cache_key = next(iter(controlnet_hold_cache))
-                        if cache_key is not cache_path:
-                            controlnet_hold_cache.pop(cache_key)
-                            # print(f'释放缓存{cache_key}')
-                controlnet_file_contents.append(load_data)
-            process_caches.append(torch.stack(controlnet_file_contents, dim=0))
-
-        if controlnet_processor_count > 0:
-            stack_controlnet_file_contents.append(torch.stack(process_caches, dim=0))
-            controlnet_cache_frames = torch.cat(stack_controlnet_file_contents, dim=0)
+    num_branches = 1 if negative_encoder_hidden_states is None else 2
+    # A shared prompt embedding is moved to the device once, per-frame embeddings are copied window by window.
+    text_embs = [
+        shared_text_emb(text_emb, device=device)
+        for text_emb in [encoder_hidden_states, negative_encoder_hidden_states][:num_branches]
+    ]
+    windows = sliding_windows(num_frames, animatediff_batch_size, animatediff_stride)
+
+    # Weighted sum of the window outputs and the sum of the weights, in float32.
+    # With accumulator_path the sums live in a memory-mapped file instead of RAM.
+    # Its checkpoints are file copies (made by LatentCheckpoint.save_partial), they never pass through RAM either.
+    accumulator_shape = (num_frames, num_branches) + tuple(sample.shape[1:])
+    accumulator_file = None
+    if accumulator_path is None:
+        accumulator = torch.zeros(accumulator_shape, dtype=torch.float32)
+    else:
+        accumulator_file = np.memmap(accumulator_path, dtype=np.float32, mode="w+", shape=accumulator_shape)
+        accumulator = torch.from_numpy(accumulator_file)
+    weights = torch.zeros((num_frames,), dtype=torch.float32)
+
+    # Continue after the last window saved by save_state_fn
+    first_window_id = 0
+    if resume_state is not None:
+        saved_accumulator = resume_state.get("accumulator", None)
+        if "accumulator_path" in resume_state:
+            saved_accumulator = None
+            if os.path.exists(resume_state["accumulator_path"]):
+                saved_accumulator = torch.from_numpy(np.memmap(resume_state["accumulator_path"], dtype=np.float32, mode="r", shape=accumulator_shape))
+        if saved_accumulator is None:
+            print('\n找不到保存的累加器，从第0个窗口开始')
+        else:
+            accumulator.copy_(saved_accumulator)
+            weights.copy_(resume_state["weights"])
+            first_window_id = resume_state["window_id"] + 1
+            print(f'\n根据保存进度，从第{first_window_id}/{len(windows)}个窗口继续')
+    last_save_time = time.time()
+
+    # The next window is loaded on a worker thread while this one is running.
+    # Frames shared by two neighbouring windows are only read once from the ControlNet caches.
+    pin_memory = torch.device(device).type == "cuda"
+    # Pinned buffers for the activations offloaded with vram_limit_level >= 1, reused by all windows.
+    offloader = ActivationOffloader(device) if vram_limit_level >= 1 else None
+    prefetcher = WindowPrefetcher(
+        windows[first_window_id:], sample, controlnet_stores,
+        cache_size=max(animatediff_batch_size - animatediff_stride, 0), pin_memory=pin_memory
+    )
+
+    for window_id, (batch_id, batch_id_, sample_batch, controlnet_cache_frames) in enumerate(tqdm(prefetcher, leave=False, desc=f'dance_batch'), start=first_window_id):
+        if controlnet_cache_frames is not None:
+            controlnet_cache_frames = controlnet_cache_frames.to(device, non_blocking=pin_memory)
+
+        sample_batch = sample_batch.to(device, non_blocking=pin_memory)
+        # A single prompt embedding is passed as it is, the UNet broadcasts it and reuses its cached K/V.
+        text_emb_batch = [
+            text_emb if text_emb.shape[0] == 1 else text_emb[batch_id: batch_id_].to(device)
+            for text_emb in text_embs
+        ]
+        if num_branches == 2:
+            sample_batch = torch.concat([sample_batch, sample_batch], dim=0)
 
         # process this batch
+        deep_features = None
+        if deep_cache is not None and deep_cache_reuse and deep_cache.has(deep_cache_key, window_id):
+            deep_features = deep_cache.load(deep_cache_key, window_id, device)
+        reuse = deep_features is not None
         hidden_states_batch = lets_dance(
             unet, motion_modules, controlnet,
-            sample[batch_id: batch_id_].to(device),
+            sample_batch,
             timestep,
-            encoder_hidden_states[batch_id: batch_id_].to(device),
-            controlnet_cache_frames.to(device) if controlnet_processor_count > 0 else None,
+            text_emb_batch,
+            controlnet_cache_frames,
             unet_batch_size=unet_batch_size, controlnet_batch_size=controlnet_batch_size,
             cross_frame_attention=cross_frame_attention,
-            device=device, vram_limit_level=vram_limit_level
-        ).cpu()
-
-        # update hidden_states
-        for i, hidden_states_updated in zip(range(batch_id, batch_id_), hidden_states_batch):
-            bias = max(1 - abs(i - (batch_id + batch_id_ - 1) / 2) / ((batch_id_ - batch_id - 1 + 1e-2) / 2), 1e-2)
-            hidden_states, num = hidden_states_output[i]
-            hidden_states = hidden_states * (num / (num + bias)) + hidden_states_updated * (bias / (num + bias))
-            hidden_states_output[i] = (hidden_states, num + bias)
-
-        if batch_id_ == num_frames:
-            break
+            device=device, vram_limit_level=vram_limit_level,
+            batch_size=num_branches, offloader=offloader, weight_streamer=weight_streamer,
+            deep_cache_depth=deep_cache_depth,
+            token_merge_ratio=token_merge_ratio, token_merge_max_downsample=token_merge_max_downsample,
+            deep_features=deep_features,
+            return_deep_features=deep_cache is not None and not reuse
+        )
+        if deep_cache is not None and not reuse:
+            hidden_states_batch, deep_features = hidden_states_batch
+            deep_cache.save(deep_cache_key, window_id, deep_features)
+        hidden_states_batch = hidden_states_batch.cpu()
+        # (branches * frames, ...) -> (frames, branches, ...)
+        hidden_states_batch = hidden_states_batch.view((num_branches, -1) + hidden_states_batch.shape[1:]).transpose(0, 1)
+
+        # update hidden_states, frames in the middle of the window get larger weights
+        frame_ids = torch.arange(batch_id, batch_id_, dtype=torch.float32)
+        bias = (1 - (frame_ids - (batch_id + batch_id_ - 1) / 2).abs() / ((batch_id_ - batch_id - 1 + 1e-2) / 2)).clamp(min=1e-2)
+        accumulator[batch_id: batch_id_] += hidden_states_batch.to(torch.float32) * bias.view((-1,) + (1,) * (hidden_states_batch.dim() - 1))
+        weights[batch_id: batch_id_] += bias
+
+        # Save the accumulators every checkpoint_seconds, a step on a long video can take hours.
+        if save_state_fn is not None and checkpoint_seconds > 0 and time.time() - last_save_time >= checkpoint_seconds \
+                and window_id + 1 < len(windows):
+            if accumulator_file is None:
+                save_state_fn({"window_id": window_id, "accumulator": accumulator, "weights": weights})
+            else:
+                accumulator_file.flush()
+                save_state_fn({"window_id": window_id, "accumulator_file": accumulator_path, "weights": weights})
+            last_save_time = time.time()
 
     # output
-    hidden_states = torch.stack([h for h, _ in hidden_states_output])
-    return hidden_states
+    hidden_states = (accumulator / weights.view((-1,) + (1,) * (accumulator.dim() - 1))).to(sample.dtype)
+    if num_branches == 2:
+        return hidden_states[:, 0], hidden_states[:, 1]
+    return hidden_states[:, 0]
 
 
 class SDVideoPipeline(torch.nn.Module):
@@ -112,6 +264,22 @@ class SDVideoPipeline(torch.nn.Module):
         self.vae_encoder: SDVAEEncoder = None
         self.controlnet: MultiControlNetManager = None
         self.motion_modules: SDMotionModel = None
+        # vram_limit_level=2, see enable_weight_streaming
+        self.weight_streamer: WeightStreamer = None
+
+    def enable_weight_streaming(self):
+        # The UNet blocks, motion modules and ControlNets stay in host memory and are copied to the device one block ahead of use.
+        # Once enabled, every later call streams the weights too.
+        if self.weight_streamer is not None:
+            return
+        self.weight_streamer = WeightStreamer(self.device)
+        self.weight_streamer.attach(self.unet, list(self.unet.blocks))
+        if self.motion_modules is not None:
+            self.weight_streamer.attach(self.motion_modules, list(self.motion_modules.motion_modules))
+        if self.controlnet is not None:
+            for model in self.controlnet.models:
+                self.weight_streamer.attach(model, [model])
+        torch.cuda.empty_cache()
 
     def fetch_main_models(self, model_manager: ModelManager):
         self.text_encoder = model_manager.text_encoder
@@ -126,7 +294,8 @@ class SDVideoPipeline(torch.nn.Module):
             controlnet_unit = ControlNetUnit(
                 Annotator(config.processor_id),
                 model_manager.get_model_with_model_path(config.model_path),
-                config.scale
+                config.scale,
+                model_path=config.model_path
             )
             controlnet_units.append(controlnet_unit)
         self.controlnet = MultiControlNetManager(controlnet_units)
@@ -163,27 +332,36 @@ class SDVideoPipeline(torch.nn.Module):
         image = Image.fromarray(((image / 2 + 0.5).clip(0, 1) * 255).astype("uint8"))
         return image
 
-    def decode_images(self, latents, output_folder, tiled=False, tile_size=64, tile_stride=32):
+    def decode_images(self, latents, output_folder, tiled=False, tile_size=64, tile_stride=32, cache_manager=None, frame_format="png"):
+        return list(self.iter_decode_images(latents, output_folder, tiled=tiled, tile_size=tile_size, tile_stride=tile_stride, cache_manager=cache_manager, frame_format=frame_format))
+
+    @torch.no_grad()
+    def iter_decode_images(self, latents, output_folder, tiled=False, tile_size=64, tile_stride=32, cache_manager=None, frame_format="png"):
+        # Yields the path of every frame as soon as it is decoded.
         cache_dir = os.path.join(output_folder, "latents")
         os.makedirs(cache_dir, exist_ok=True)
 
-        result = []
         for frame_id in tqdm(range(latents.shape[0]), desc="VAE Decode"):
-            save_path = os.path.join(cache_dir, f'image_{frame_id}.png')
+            save_path = os.path.join(cache_dir, frame_file_name(f'image_{frame_id}', frame_format))
             image = self.decode_image(latents[frame_id: frame_id + 1], tiled=tiled, tile_size=tile_size, tile_stride=tile_stride)
             if image is None:
                 print(f"latent failed at {frame_id} , try smaller tile_size")
                 tile_size = 32
                 image = self.decode_image(latents[frame_id: frame_id + 1], tiled=tiled, tile_size=tile_size, tile_stride=tile_stride)
             if image is not None:
-                image.save(save_path)
-                result.append(save_path)
+                if cache_manager is not None:
+                    # The png is written in the background while the next frame is decoded.
+                    cache_manager.write("latents", save_path, save_frame, image, recompute_fn=self.decode_image_to_file(
+                        latents[frame_id: frame_id + 1], save_path, tiled=tiled, tile_size=tile_size, tile_stride=tile_stride
+                    ))
+                else:
+                    save_frame(save_path, image)
+                yield save_path
             else:
                 print(f"latent failed at {frame_id} , all try failed, saved latents.pt")
                 latent_path = cache_dir + "/latents.pt"
                 torch.save(latents, latent_path)
                 break
-        return result
         # images = [
         #     self.decode_image(latents[frame_id: frame_id + 1], tiled=tiled, tile_size=tile_size,
         #                       tile_stride=tile_stride)
@@ -191,11 +369,17 @@ class SDVideoPipeline(torch.nn.Module):
         # ]
         # return images
 
-    def encode_images(self, processed_images, tiled=False, tile_size=64, tile_stride=32):
+    def decode_image_to_file(self, latent, save_path, tiled=False, tile_size=64, tile_stride=32):
+        # Used by the cache manager to rebuild an evicted frame.
+        def recompute_fn():
+            save_frame(save_path, self.decode_image(latent, tiled=tiled, tile_size=tile_size, tile_stride=tile_stride))
+        return recompute_fn
+
+    def encode_images(self, processed_images, tiled=False, tile_size=64, tile_stride=32, cache_manager=None):
         latents = []
         for image in processed_images:
             if isinstance(image, str):
-                image = Image.open(image)
+                image = cache_manager.load(image, load_frame_array) if cache_manager is not None else load_frame(image)
             image = self.preprocess_image(image).to(device=self.device, dtype=self.torch_dtype)
             latent = self.vae_encoder(image, tiled=tiled, tile_size=tile_size, tile_stride=tile_stride).cpu()
             latents.append(latent)
@@ -203,6 +387,132 @@ class SDVideoPipeline(torch.nn.Module):
         latents = torch.concat(latents, dim=0)
         return latents
 
+    def source_frame_key(self, frame, cache_manager=None):
+        # Frames cached by VideoData carry the hash of their parameters in the manifest of their folder.
+        key = CacheManifest.open(os.path.dirname(frame)).get(os.path.basename(frame))
+        if key is None:
+            if cache_manager is not None:
+                cache_manager.fetch(frame)
+            key = file_signature(frame)
+        return key
+
+    def prepare_controlnet_caches(self, controlnet_frames, controlnet_cache_dir, height, width, progress_bar_cmd=tqdm, cache_manager=None, embed_conditioning=False,
+                                  num_workers=0, batch_size=1):
+        # One memory-mapped file (num_frames, 3, height, width) per processor.
+        # With embed_conditioning, the ControlNet conditioning embedding (num_frames, 320, height // 8, width // 8) is stored instead,
+        # so the full resolution convolutions of controlnet_conv_in run once per frame and not in every window of every step.
+        # It needs about 1.7 times the disk space of the frames, so it is off by default.
+        # A frame is only processed again if it is missing or if the manifest says it is stale,
+        # i.e. the annotator settings or the source frame changed. The prompt is not part of the key.
+        # Frames are annotated by num_workers workers (see MultiControlNetManager.process_images) and embedded batch_size at a time.
+        # Results are stored in frame order, an interrupted run continues with the frames that are still missing.
+        # The files count towards the controlnet_caches budget. They can be rebuilt from the frames, so they may be evicted,
+        # the embeddings first. An evicted file that is still mapped keeps its data until the store is closed.
+        if not isinstance(controlnet_frames[0], list):
+            controlnet_frames = [controlnet_frames]
+        manifest = CacheManifest.open(controlnet_cache_dir)
+        controlnet_stores = []
+        for processor_id, frames in enumerate(controlnet_frames):
+            build_store = partial(
+                self.build_controlnet_store, processor_id, frames, controlnet_cache_dir, manifest, height, width,
+                progress_bar_cmd=progress_bar_cmd, cache_manager=cache_manager, embed_conditioning=embed_conditioning,
+                num_workers=num_workers, batch_size=batch_size
+            )
+            store = build_store()
+            if cache_manager is not None:
+                cache_manager.track("controlnet_caches", store.path, priority=-1 if embed_conditioning else 0, recompute_fn=build_store)
+                if cache_manager.reserve(store.nbytes):
+                    store.load_to_memory()
+            controlnet_stores.append(store)
+        return controlnet_stores
+
+    def build_controlnet_store(self, processor_id, frames, controlnet_cache_dir, manifest, height, width, progress_bar_cmd=tqdm, cache_manager=None,
+                               embed_conditioning=False, num_workers=0, batch_size=1):
+        # Fills the stale frames of the store of one processor, see prepare_controlnet_caches.
+        annotator = self.controlnet.processors[processor_id]
+        processor_config = {
+            "processor_id": annotator.processor_id,
+            "detect_resolution": annotator.detect_resolution,
+            "dtype": self.torch_dtype,
+            "height": height,
+            "width": width,
+        }
+        if embed_conditioning:
+            # The embedding also depends on the ControlNet weights.
+            model_path = self.controlnet.model_paths[processor_id]
+            processor_config["model"] = file_signature(model_path) if model_path is not None and os.path.isfile(model_path) else model_path
+            store_name = f"processor_{processor_id}_embedding"
+            frame_shape = (320, height // 8, width // 8)
+        else:
+            store_name = f"processor_{processor_id}"
+            frame_shape = (3, height, width)
+        store_path = os.path.join(controlnet_cache_dir, f"{store_name}.bin")
+        store = MemmapTensorStore(store_path, len(frames), frame_shape, dtype=self.torch_dtype)
+        frame_keys = [config_hash(processor=processor_config, frame=self.source_frame_key(frame, cache_manager)) for frame in frames]
+        # The number of frames changed (another frame range, dedup_frames or keyframes). The frames of the previous store
+        # that were made from the same source frame with the same settings are moved to their new position.
+        if store.previous is not None:
+            previous_ids = {}
+            for index in reversed(range(store.previous_frames)):
+                key = manifest.get(f"{store_name}/{index}")
+                if key is not None:
+                    previous_ids[key] = index
+            copied = set(store.remap([previous_ids.get(key) for key in frame_keys]))
+            for index in range(max(len(frames), store.previous_frames)):
+                if index in copied:
+                    manifest.set(f"{store_name}/{index}", frame_keys[index])
+                else:
+                    manifest.invalidate(f"{store_name}/{index}")
+            manifest.save()
+        else:
+            # Only removes unusable leftovers of an interrupted remap
+            store.remap([])
+        stale_frames = [
+            index for index in range(len(frames))
+            if not store.is_done(index) or not manifest.is_valid(f"{store_name}/{index}", frame_keys[index])
+        ]
+        pinned_paths = []
+        if cache_manager is not None:
+            # Worker threads and processes read the files, so an evicted frame is rebuilt here on the main thread
+            # (the video reader is not thread-safe) right before it is handed to them, and stays pinned until its
+            # conditioning is stored. process_images only runs a few frames ahead, the pinned frames stay bounded.
+            def fetch_frame(index):
+                path = cache_manager.pin(frames[index])
+                pinned_paths.append(path)
+                return cache_manager.fetch(path)
+            stale_paths = (fetch_frame(index) for index in stale_frames)
+            load_fn = lambda path: Image.fromarray(cache_manager.load(path, load_frame_array))
+        else:
+            stale_paths = [frames[index] for index in stale_frames]
+            load_fn = None
+        conditionings = self.controlnet.process_images(stale_paths, processor_id, num_workers=num_workers, load_fn=load_fn)
+        if embed_conditioning and self.weight_streamer is not None:
+            self.weight_streamer.load(self.controlnet.models[processor_id])
+        batch = []
+        try:
+            for position, conditioning in enumerate(progress_bar_cmd(conditionings, total=len(stale_frames), desc=f'make_controlnet_processor_{processor_id}_cache')):
+                batch.append((stale_frames[position], conditioning))
+                if len(batch) < batch_size and position + 1 < len(stale_frames):
+                    continue
+                conditioning = torch.concat([conditioning for _, conditioning in batch], dim=0)
+                if embed_conditioning:
+                    conditioning = self.controlnet.embed_conditioning(conditioning, processor_id)
+                for (index, _), conditioning_ in zip(batch, conditioning):
+                    store[index] = conditioning_
+                    manifest.set(f"{store_name}/{index}", frame_keys[index])
+                    if frames[index] in pinned_paths:
+                        pinned_paths.remove(frames[index])
+                        cache_manager.unpin(frames[index])
+                batch = []
+        finally:
+            for path in pinned_paths:
+                cache_manager.unpin(path)
+        if embed_conditioning and self.weight_streamer is not None:
+            self.weight_streamer.evict(self.controlnet.models[processor_id])
+        store.flush()
+        manifest.save()
+        return store
+
     @torch.no_grad()
     def __call__(
             self,
@@ -229,7 +539,26 @@ class SDVideoPipeline(torch.nn.Module):
             progress_bar_st=None,
             clear_output_folder=False,
             output_folder="output",
+            cache_manager=None,
+            frame_format="png",
+            checkpoint_snapshots=0,
+            window_checkpoint_seconds=600,
+            batch_cfg=False,
+            accumulator_on_disk=False,
+            controlnet_embedding_cache=False,
+            annotation_workers=0,
+            stream_queue_size=8,
+            output_writer=None,
+            frame_key=None,
+            deep_cache_interval=0,
+            deep_cache_depth=1,
+            deep_cache_on_disk=True,
+            token_merge_ratio=0.0,
+            token_merge_max_downsample=1,
     ):
+        if cache_manager is None:
+            cache_manager = DiskCacheManager()
+
         # Prepare controlnet cacheDir
 
         controlnet_cache_dir = os.path.join(output_folder, "controlnet_caches")
@@ -247,54 +576,62 @@ class SDVideoPipeline(torch.nn.Module):
         if input_frames is None or denoising_strength == 1.0:
             latents = noise
         else:
-            latents = self.encode_images(input_frames)
+            latents = self.encode_images(input_frames, cache_manager=cache_manager)
             latents = self.scheduler.add_noise(latents, noise, timestep=self.scheduler.timesteps[0])
 
         # Encode prompts
+        # They stay on the device with batch size 1, the cross-attention K/V are computed once per layer and reused.
         prompt_emb_posi = self.prompter.encode_prompt(self.text_encoder, prompt, clip_skip=clip_skip,
-                                                      device=self.device, positive=True).cpu()
+                                                      device=self.device, positive=True)
         prompt_emb_nega = self.prompter.encode_prompt(self.text_encoder, negative_prompt, clip_skip=clip_skip,
-                                                      device=self.device, positive=False).cpu()
-        prompt_emb_posi = prompt_emb_posi.repeat(num_frames, 1, 1)
-        prompt_emb_nega = prompt_emb_nega.repeat(num_frames, 1, 1)
+                                                      device=self.device, positive=False)
+        mark_kv_cacheable(prompt_emb_posi)
+        mark_kv_cacheable(prompt_emb_nega)
 
-        controlnet_processor_count = self.controlnet.unit_count() if controlnet_frames is not None else 0
+        if vram_limit_level >= 2:
+            self.enable_weight_streaming()
 
         # Prepare ControlNets
+        controlnet_stores = None
         if controlnet_frames is not None:
-            if isinstance(controlnet_frames[0], list):
-                for processor_id in range(len(controlnet_frames)):
-                    index = 0
-                    for controlnet_frame in progress_bar_cmd(controlnet_frames[processor_id], desc=f'make_controlnet_processor_{processor_id}_cache'):
-                        cache_full_path = controlnet_cache_dir + f'/cache_p{processor_id}_{index}.pt'
-                        if not os.path.exists(cache_full_path):
-                            tensor_data = self.controlnet.process_image(controlnet_frame, processor_id=processor_id).to(self.torch_dtype)
-                            torch.save(tensor_data, cache_full_path)
-                        index += 1
-            else:
-                controlnet_processor_count = 1
-                index = 0
-                for controlnet_frame in progress_bar_cmd(controlnet_frames):
-                    cache_full_path = controlnet_cache_dir + f'/cache_p0_{index}.pt'
-                    if not os.path.exists(cache_full_path):
-                        tensor_data = self.controlnet.process_image(controlnet_frame).to(self.torch_dtype)
-                        torch.save(tensor_data, cache_full_path)
-                    index += 1
-                # controlnet_frames = torch.stack([
-                #     self.controlnet.process_image(controlnet_frame).to(self.torch_dtype)
-                #     for controlnet_frame in progress_bar_cmd(controlnet_frames)
-                # ], dim=1)
+            controlnet_stores = self.prepare_controlnet_caches(
+                controlnet_frames, controlnet_cache_dir, height, width,
+                progress_bar_cmd=progress_bar_cmd, cache_manager=cache_manager,
+                embed_conditioning=controlnet_embedding_cache,
+                num_workers=annotation_workers, batch_size=controlnet_batch_size
+            )
+
+        # Both CFG branches in one batch need twice the activations, so it is disabled when VRAM is limited.
+        batch_cfg = batch_cfg and vram_limit_level < 1
+        accumulator_path = os.path.join(output_folder, "accumulator.bin") if accumulator_on_disk else None
+        # DeepCache: only every deep_cache_interval-th step runs the whole UNet,
+        # the steps in between recompute the shallow blocks and reuse the deep features (see deep_cache_blocks).
+        deep_cache = None
+        if deep_cache_interval > 1:
+            deep_cache = DeepFeatureCache(os.path.join(output_folder, "deep_cache") if deep_cache_on_disk else None, cache_manager=cache_manager)
 
         # Denoise
-        save_process_id_path = output_folder + "/last_process_id.txt"
+        checkpoint = LatentCheckpoint(output_folder, writer=cache_manager.writer, keep_snapshots=checkpoint_snapshots)
         saved_process_id = -1
-        if os.path.exists(save_process_id_path):
-            with open(save_process_id_path) as f:
-                saved_process_id = int(f.read())
-
-        cache_latents_path = output_folder + '/latents.py'
-        if saved_process_id > -1 and os.path.exists(cache_latents_path):
-            latents = torch.load(cache_latents_path)
+        saved_state = checkpoint.load()
+        # frame_key identifies which source frames are rendered (dedup_frames, keyframes), see SDVideoPipelineRunner.
+        # A checkpoint of another frame selection cannot be resumed, the latents do not even have the same shape.
+        if saved_state is not None and (saved_state["latents"].shape[0] != num_frames
+                                        or saved_state.get("frame_key", frame_key) != frame_key):
+            print(f'\n保存的进度有{saved_state["latents"].shape[0]}帧，当前有{num_frames}帧（或帧选择不同），不使用保存的进度')
+            saved_state = None
+        if saved_state is not None:
+            saved_process_id = saved_state["progress_id"]
+            latents = saved_state["latents"].to(self.torch_dtype)
+        # Window accumulators are only reused with the same settings.
+        partial_key = config_hash(
+            prompt=prompt, negative_prompt=negative_prompt, clip_skip=clip_skip, num_frames=num_frames, frame_key=frame_key,
+            animatediff_batch_size=animatediff_batch_size, animatediff_stride=animatediff_stride,
+            num_inference_steps=num_inference_steps, denoising_strength=denoising_strength, batch_cfg=batch_cfg,
+            deep_cache_interval=deep_cache_interval, deep_cache_depth=deep_cache_depth,
+            token_merge_ratio=token_merge_ratio, token_merge_max_downsample=token_merge_max_downsample,
+            state_format="accumulator"
+        )
 
         for progress_id, timestep in enumerate(progress_bar_cmd(self.scheduler.timesteps)):
             timestep = torch.IntTensor((timestep,))[0].to(self.device)
@@ -303,65 +640,121 @@ class SDVideoPipeline(torch.nn.Module):
                 time.sleep(1)
                 continue
 
-            # Classifier-free guidance
-            noise_pred_posi = lets_dance_with_long_video(
-                self.unet, motion_modules=self.motion_modules, controlnet=self.controlnet,
-                sample=latents, timestep=timestep, encoder_hidden_states=prompt_emb_posi,
-                controlnet_processor_count=controlnet_processor_count,
-                animatediff_batch_size=animatediff_batch_size, animatediff_stride=animatediff_stride,
-                unet_batch_size=unet_batch_size, controlnet_batch_size=controlnet_batch_size,
-                cross_frame_attention=cross_frame_attention,
-                controlnet_cache_dir=controlnet_cache_dir,
-                device=self.device, vram_limit_level=vram_limit_level
-            )
-            noise_pred_nega = lets_dance_with_long_video(
-                self.unet, motion_modules=self.motion_modules, controlnet=self.controlnet,
-                sample=latents, timestep=timestep, encoder_hidden_states=prompt_emb_nega,
-                controlnet_processor_count=controlnet_processor_count,
-                animatediff_batch_size=animatediff_batch_size, animatediff_stride=animatediff_stride,
-                unet_batch_size=unet_batch_size, controlnet_batch_size=controlnet_batch_size,
-                cross_frame_attention=cross_frame_attention,
-                controlnet_cache_dir=controlnet_cache_dir,
-                device=self.device, vram_limit_level=vram_limit_level
+            # Progress inside this step, only if it was interrupted last time
+            partial_state = None
+            if window_checkpoint_seconds > 0 and progress_id == saved_process_id + 1:
+                partial_state = checkpoint.load_partial(progress_id, partial_key)
+            branch_state = lambda branch: partial_state if partial_state is not None and partial_state.get("branch") == branch else None
+            # The latents jump after the smoother, the deep features of the previous step are too different then.
+            deep_cache_reuse = deep_cache is not None and progress_id % deep_cache_interval != 0 and progress_id - 1 not in smoother_progress_ids
+            unet_args = dict(
+                deep_cache=deep_cache, deep_cache_reuse=deep_cache_reuse, deep_cache_depth=deep_cache_depth,
+                token_merge_ratio=token_merge_ratio, token_merge_max_downsample=token_merge_max_downsample
             )
+
+            # Classifier-free guidance
+            if batch_cfg:
+                noise_pred_posi, noise_pred_nega = lets_dance_with_long_video(
+                    self.unet, motion_modules=self.motion_modules, controlnet=self.controlnet,
+                    sample=latents, timestep=timestep,
+                    encoder_hidden_states=prompt_emb_posi, negative_encoder_hidden_states=prompt_emb_nega,
+                    controlnet_stores=controlnet_stores,
+                    animatediff_batch_size=animatediff_batch_size, animatediff_stride=animatediff_stride,
+                    unet_batch_size=unet_batch_size, controlnet_batch_size=controlnet_batch_size,
+                    cross_frame_attention=cross_frame_attention,
+                    device=self.device, vram_limit_level=vram_limit_level, weight_streamer=self.weight_streamer,
+                    accumulator_path=accumulator_path, resume_state=branch_state("both"), checkpoint_seconds=window_checkpoint_seconds,
+                    deep_cache_key="both", **unet_args,
+                    save_state_fn=lambda state: checkpoint.save_partial(progress_id, partial_key, branch="both", blocking=True, **state)
+                )
+            else:
+                if partial_state is not None and "noise_pred_posi" in partial_state:
+                    noise_pred_posi = partial_state["noise_pred_posi"]
+                else:
+                    noise_pred_posi = lets_dance_with_long_video(
+                        self.unet, motion_modules=self.motion_modules, controlnet=self.controlnet,
+                        sample=latents, timestep=timestep, encoder_hidden_states=prompt_emb_posi,
+                        controlnet_stores=controlnet_stores,
+                        animatediff_batch_size=animatediff_batch_size, animatediff_stride=animatediff_stride,
+                        unet_batch_size=unet_batch_size, controlnet_batch_size=controlnet_batch_size,
+                        cross_frame_attention=cross_frame_attention,
+                        device=self.device, vram_limit_level=vram_limit_level, weight_streamer=self.weight_streamer,
+                        accumulator_path=accumulator_path, resume_state=branch_state("posi"), checkpoint_seconds=window_checkpoint_seconds,
+                        deep_cache_key="posi", **unet_args,
+                        save_state_fn=lambda state: checkpoint.save_partial(progress_id, partial_key, branch="posi", blocking=True, **state)
+                    )
+                    if window_checkpoint_seconds > 0:
+                        checkpoint.save_partial(progress_id, partial_key, noise_pred_posi=noise_pred_posi)
+                noise_pred_nega = lets_dance_with_long_video(
+                    self.unet, motion_modules=self.motion_modules, controlnet=self.controlnet,
+                    sample=latents, timestep=timestep, encoder_hidden_states=prompt_emb_nega,
+                    controlnet_stores=controlnet_stores,
+                    animatediff_batch_size=animatediff_batch_size, animatediff_stride=animatediff_stride,
+                    unet_batch_size=unet_batch_size, controlnet_batch_size=controlnet_batch_size,
+                    cross_frame_attention=cross_frame_attention,
+                    device=self.device, vram_limit_level=vram_limit_level, weight_streamer=self.weight_streamer,
+                    accumulator_path=accumulator_path, resume_state=branch_state("nega"), checkpoint_seconds=window_checkpoint_seconds,
+                    deep_cache_key="nega", **unet_args,
+                    save_state_fn=lambda state: checkpoint.save_partial(progress_id, partial_key, branch="nega", noise_pred_posi=noise_pred_posi, blocking=True, **state)
+                )
             noise_pred = noise_pred_nega + cfg_scale * (noise_pred_posi - noise_pred_nega)
 
             # DDIM and smoother
             if smoother is not None and progress_id in smoother_progress_ids:
+                # decode -> smoother -> encode, connected by bounded queues so that a frame moves on as soon as it is ready.
+                # Each frame file is waited for when it is read, there is no flush of the whole video in between.
                 rendered_frames = self.scheduler.step(noise_pred, timestep, latents, to_final=True)
-                rendered_frames = self.decode_images(rendered_frames, output_folder)
-                rendered_frames = smoother(rendered_frames, original_frames=input_frames)
-                target_latents = self.encode_images(rendered_frames)
+                rendered_frames = self.iter_decode_images(rendered_frames, output_folder, cache_manager=cache_manager, frame_format=frame_format)
+                rendered_frames = self.smooth_frames(smoother, rendered_frames, input_frames, cache_manager, stream_queue_size)
+                target_latents = self.encode_images(background_iter(rendered_frames, stream_queue_size), cache_manager=cache_manager)
                 noise_pred = self.scheduler.return_to_timestep(timestep, latents, target_latents)
             latents = self.scheduler.step(noise_pred, timestep, latents)
 
-            with open(save_process_id_path, 'w') as f:
-                f.write(str(progress_id))
-            torch.save(latents, cache_latents_path)
+            checkpoint.save(progress_id, latents, num_frames=num_frames, frame_key=frame_key)
 
             # UI
             if progress_bar_st is not None:
                 progress_bar_st.progress(progress_id / len(self.scheduler.timesteps))
 
+        if deep_cache is not None:
+            deep_cache.clear()
+        clear_kv_cache(self.unet)
+        if self.controlnet is not None:
+            for model in self.controlnet.models:
+                clear_kv_cache(model)
+
         # Decode image
-        output_frames = self.decode_images(latents, output_folder)
+        output_frames = self.iter_decode_images(latents, output_folder, cache_manager=cache_manager, frame_format=frame_format)
 
         # Post-process
         if smoother is not None and (num_inference_steps in smoother_progress_ids or -1 in smoother_progress_ids):
-            output_frames = smoother(output_frames, original_frames=input_frames)
+            output_frames = self.smooth_frames(smoother, output_frames, input_frames, cache_manager, stream_queue_size)
+
+        # With output_writer, every final frame is exported as soon as it exists.
+        result = []
+        for frame in output_frames:
+            if output_writer is not None:
+                output_writer.add(frame)
+            result.append(frame)
+        return result
 
-        return output_frames
+    def smooth_frames(self, smoother, rendered_frames, input_frames, cache_manager, stream_queue_size=8):
+        # rendered_frames: iterator of frame files, the smoothed frames are returned as an iterator as well.
+        return smoother.stream(background_iter(rendered_frames, stream_queue_size), original_frames=input_frames, cache_manager=cache_manager)
 
 
 class SDVideoPipelineRunner:
     def __init__(self, in_streamlit=False):
         self.in_streamlit = in_streamlit
 
-    def load_pipeline(self, model_list, textual_inversion_folder, device, lora_alphas, controlnet_units):
+    def load_pipeline(self, model_list, textual_inversion_folder, device, lora_alphas, controlnet_units, sequential_offload=False, memory_budget=None):
         # Load models
-        model_manager = ModelManager(torch_dtype=torch.float16, device=device)
+        model_manager = ModelManager(torch_dtype=torch.float16, device=device, sequential_offload=sequential_offload)
         model_manager.load_textual_inversions(textual_inversion_folder)
         model_manager.load_models(model_list, lora_alphas=lora_alphas)
+        # e.g. "memory_budget": "512MiB", attention and feed-forward layers work in chunks of this size
+        if memory_budget is not None:
+            model_manager.set_memory_budget(parse_size(memory_budget))
         pipe = SDVideoPipeline.from_model_manager(
             model_manager,
             [
@@ -374,47 +767,122 @@ class SDVideoPipelineRunner:
         )
         return model_manager, pipe
 
-    def load_smoother(self, model_manager, output_folder, smoother_configs):
-        smoother = SequencialProcessor.from_model_manager(model_manager, output_folder, smoother_configs)
+    def load_smoother(self, model_manager, output_folder, smoother_configs, cache_manager=None):
+        smoother = SequencialProcessor.from_model_manager(model_manager, output_folder, smoother_configs, cache_manager=cache_manager)
         return smoother
 
-    def synthesize_video(self, model_manager, pipe, seed, smoother, **pipeline_inputs):
+    def synthesize_video(self, model_manager, pipe, seed, smoother, cache_manager=None, output_writer=None, **pipeline_inputs):
         torch.manual_seed(seed)
         if self.in_streamlit:
             import streamlit as st
             progress_bar_st = st.progress(0.0)
-            output_video = pipe(**pipeline_inputs, smoother=smoother, progress_bar_st=progress_bar_st)
+            output_video = pipe(**pipeline_inputs, smoother=smoother, progress_bar_st=progress_bar_st, cache_manager=cache_manager, output_writer=output_writer)
             progress_bar_st.progress(1.0)
         else:
-            output_video = pipe(**pipeline_inputs, smoother=smoother)
+            output_video = pipe(**pipeline_inputs, smoother=smoother, cache_manager=cache_manager, output_writer=output_writer)
         model_manager.to("cpu")
         return output_video
 
-    def load_video(self, video_file, image_folder, output_folder, height, width, start_frame_id, end_frame_id):
-        image_cache_folder = os.path.join(output_folder, "source_images")
+    def load_video(self, video_file, image_folder, output_folder, height, width, start_frame_id, end_frame_id, cache_manager=None, cache_name="source_images", frame_format="png"):
+        image_cache_folder = os.path.join(output_folder, cache_name)
         os.makedirs(image_cache_folder, exist_ok=True)
-        video = VideoData(video_file=video_file, image_folder=image_folder, image_cache_folder=image_cache_folder, height=height, width=width)
+        video = VideoData(video_file=video_file, image_folder=image_folder, image_cache_folder=image_cache_folder, height=height, width=width, cache_manager=cache_manager, frame_format=frame_format)
         if start_frame_id is None:
             start_frame_id = 0
         if end_frame_id is None:
             end_frame_id = len(video)
         frames = [video[i] for i in tqdm(range(start_frame_id, end_frame_id), desc="Decode Images")]
+        if cache_manager is not None:
+            cache_manager.flush(fsync=False)
+        video.manifest.save()
         return frames
 
-    def add_data_to_pipeline_inputs(self, data, pipeline_inputs):
-        pipeline_inputs["input_frames"] = self.load_video(**data["input_frames"], output_folder=data["output_folder"])
+    def add_data_to_pipeline_inputs(self, data, pipeline_inputs, cache_manager=None):
+        # Format of the intermediate frames: "png", "npy" (raw, fastest) or "lz4" (compressed raw, needs the lz4 package)
+        frame_format = data.get("frame_format", "png")
+        pipeline_inputs["frame_format"] = frame_format
+        pipeline_inputs["input_frames"] = self.load_video(**data["input_frames"], output_folder=data["output_folder"], cache_manager=cache_manager, frame_format=frame_format)
         pipeline_inputs["num_frames"] = len(pipeline_inputs["input_frames"])
-        pipeline_inputs["width"], pipeline_inputs["height"] = Image.open(pipeline_inputs["input_frames"][0]).size
+        first_frame = pipeline_inputs["input_frames"][0]
+        first_frame = cache_manager.load(first_frame, load_frame_array) if cache_manager is not None else load_frame_array(first_frame)
+        pipeline_inputs["height"], pipeline_inputs["width"] = first_frame.shape[:2]
         pipeline_inputs["clear_output_folder"] = data["clear_output_folder"]
         pipeline_inputs["output_folder"] = data["output_folder"]
         if len(data["controlnet_frames"]) > 0:
-            pipeline_inputs["controlnet_frames"] = [self.load_video(**unit, output_folder=data["output_folder"]) for unit in data["controlnet_frames"]]
+            pipeline_inputs["controlnet_frames"] = []
+            for unit_id, unit in enumerate(data["controlnet_frames"]):
+                # Frames of another video must not overwrite the input frames in source_images.
+                same_source = all(unit.get(key) == data["input_frames"].get(key) for key in ["video_file", "image_folder", "height", "width"])
+                cache_name = "source_images" if same_source else f"source_images_controlnet_{unit_id}"
+                pipeline_inputs["controlnet_frames"].append(self.load_video(**unit, output_folder=data["output_folder"], cache_manager=cache_manager, cache_name=cache_name, frame_format=frame_format))
         return pipeline_inputs
 
-    def save_output(self, video, output_folder, fps, config):
+    def dedup_frames(self, data, pipeline_inputs, cache_manager=None):
+        # Only the first frame of every held drawing is rendered, see find_held_frames.
+        # Returns frame_map, which expands the rendered frames back to the original timeline.
+        sequences = [pipeline_inputs["input_frames"]]
+        for frames in pipeline_inputs.get("controlnet_frames", []):
+            if frames != pipeline_inputs["input_frames"]:
+                sequences.append(frames)
+        unique_ids, frame_map = find_held_frames(sequences, threshold=data.get("dedup_threshold", 1.0), cache_manager=cache_manager, progress_bar_cmd=tqdm)
+        print(f"{len(unique_ids)}/{len(frame_map)} frames are unique")
+        pipeline_inputs["input_frames"] = [pipeline_inputs["input_frames"][i] for i in unique_ids]
+        if "controlnet_frames" in pipeline_inputs:
+            pipeline_inputs["controlnet_frames"] = [[frames[i] for i in unique_ids] for frames in pipeline_inputs["controlnet_frames"]]
+        pipeline_inputs["num_frames"] = len(unique_ids)
+        return frame_map
+
+    def select_keyframes(self, keyframe_config, pipeline_inputs):
+        # Every interval-th frame and the last one are rendered by the pipeline, the others are propagated from them.
+        num_frames = pipeline_inputs["num_frames"]
+        keyframe_ids = list(range(0, num_frames, keyframe_config.get("interval", 10)))
+        if keyframe_ids[-1] != num_frames - 1:
+            keyframe_ids.append(num_frames - 1)
+        print(f"{len(keyframe_ids)}/{num_frames} frames are rendered as keyframes")
+        guide_frames = pipeline_inputs["input_frames"]
+        pipeline_inputs["input_frames"] = [guide_frames[i] for i in keyframe_ids]
+        if "controlnet_frames" in pipeline_inputs:
+            pipeline_inputs["controlnet_frames"] = [[frames[i] for i in keyframe_ids] for frames in pipeline_inputs["controlnet_frames"]]
+        pipeline_inputs["num_frames"] = len(keyframe_ids)
+        return keyframe_ids, guide_frames
+
+    def propagate_keyframes(self, keyframe_config, guide_frames, keyframes, keyframe_ids, output_folder, cache_manager=None):
+        # FastBlend interpolation: every frame between two keyframes is patch-matched from both and blended by distance.
+        from ..extensions.FastBlend.runners import InterpolationModeRunner, InterpolationModeSingleFrameRunner
+        save_path = os.path.join(output_folder, "keyframe_propagation")
+        os.makedirs(save_path, exist_ok=True)
+        if cache_manager is not None:
+            cache_manager.flush(fsync=False)
+        ebsynth_config = {
+            "minimum_patch_size": keyframe_config.get("minimum_patch_size", 5),
+            "threads_per_block": 8,
+            "num_iter": keyframe_config.get("num_iter", 5),
+            "gpu_id": 0,
+            "guide_weight": keyframe_config.get("guide_weight", 10.0),
+            "initialize": keyframe_config.get("initialize", "identity"),
+            "tracking_window_size": keyframe_config.get("tracking_window_size", 0),
+        }
+        frames_guide = FrameSequence(guide_frames, cache_manager=cache_manager)
+        frames_style = FrameSequence(keyframes, cache_manager=cache_manager)
+        batch_size = keyframe_config.get("batch_size", 8)
+        if len(keyframe_ids) == 1:
+            InterpolationModeSingleFrameRunner().run(frames_guide, frames_style, keyframe_ids, batch_size=batch_size, ebsynth_config=ebsynth_config, save_path=save_path)
+        else:
+            InterpolationModeRunner().run(frames_guide, frames_style, keyframe_ids, batch_size=batch_size, ebsynth_config=ebsynth_config, save_path=save_path)
+        frames = [os.path.join(save_path, "%05d.png" % i) for i in range(len(guide_frames))]
+        # The keyframes themselves are kept as rendered.
+        for keyframe, frame_id in zip(keyframes, keyframe_ids):
+            frames[frame_id] = keyframe
+        return frames
+
+    def save_output(self, video, output_folder, fps, config, cache_manager=None, output_writer=None):
         os.makedirs(output_folder, exist_ok=True)
-        save_frames(video, os.path.join(output_folder, "frames"))
-        save_video(video, os.path.join(output_folder, "video.mp4"), fps=fps)
+        if output_writer is not None:
+            # frames/ and video.mp4 were written during the run, only wait for the last frames.
+            output_writer.close()
+        else:
+            save_frames(video, os.path.join(output_folder, "frames"), cache_manager=cache_manager)
+            save_video(video, os.path.join(output_folder, "video.mp4"), fps=fps, cache_manager=cache_manager)
         config["pipeline"]["pipeline_inputs"]["input_frames"] = []
         config["pipeline"]["pipeline_inputs"]["controlnet_frames"] = []
         with open(os.path.join(output_folder, "config.json"), 'w') as file:
@@ -435,27 +903,62 @@ class SDVideoPipelineRunner:
                 except Exception as e:
                     print('Failed to delete %s. Reason: %s' % (file_path, e))
 
+        # Budgets per cache class, e.g. {"source_images": "20GiB", "controlnet_caches": "40GiB"}
+        # Cache files are written by background threads unless "background_writes" is false.
+        writer = None
+        if config["data"].get("background_writes", True):
+            writer = BackgroundWriter(num_workers=config["data"].get("io_workers", 2))
+        # Hot cache entries are also kept in RAM, e.g. "ram_budget": "32GiB". 0 keeps everything on disk only.
+        cache_manager = TieredCache(config["data"].get("cache_budgets", {}), writer=writer, ram_budget=config["data"].get("ram_budget", 0))
+
         if self.in_streamlit:
             import streamlit as st
         if self.in_streamlit: st.markdown("Loading videos ...")
         config["pipeline"]["pipeline_inputs"] = self.add_data_to_pipeline_inputs(config["data"],
-                                                                                 config["pipeline"]["pipeline_inputs"])
+                                                                                 config["pipeline"]["pipeline_inputs"],
+                                                                                 cache_manager=cache_manager)
+        # Anime is often animated on twos or threes, held frames are rendered once and repeated afterwards.
+        frame_map = None
+        if config["data"].get("dedup_frames", False):
+            frame_map = self.dedup_frames(config["data"], config["pipeline"]["pipeline_inputs"], cache_manager=cache_manager)
+        # Only keyframes go through the diffusion pipeline, e.g. "keyframes": {"interval": 10}
+        keyframe_config = config["data"].get("keyframes", None)
+        if keyframe_config is not None:
+            keyframe_ids, guide_frames = self.select_keyframes(keyframe_config, config["pipeline"]["pipeline_inputs"])
+        # Saved latents are only resumed with the same frame selection.
+        if frame_map is not None or keyframe_config is not None:
+            config["pipeline"]["pipeline_inputs"]["frame_key"] = config_hash(
+                frame_map=frame_map, keyframe_ids=keyframe_ids if keyframe_config is not None else None
+            )
         if self.in_streamlit: st.markdown("Loading videos ... done!")
         if self.in_streamlit: st.markdown("Loading models ...")
-        model_manager, pipe = self.load_pipeline(**config["models"])
+        # vram_limit_level=2 streams the weights block by block, they are not loaded onto the device at all.
+        sequential_offload = config["pipeline"]["pipeline_inputs"].get("vram_limit_level", 0) >= 2
+        model_manager, pipe = self.load_pipeline(**config["models"], sequential_offload=sequential_offload)
         if self.in_streamlit: st.markdown("Loading models ... done!")
         if "smoother_configs" in config:
             if self.in_streamlit: st.markdown("Loading smoother ...")
-            smoother = self.load_smoother(model_manager, output_folder=output_folder, smoother_configs=config["smoother_configs"])
+            smoother = self.load_smoother(model_manager, output_folder=output_folder, smoother_configs=config["smoother_configs"], cache_manager=cache_manager)
             if self.in_streamlit: st.markdown("Loading smoother ... done!")
         else:
             smoother = None
+        # The output is exported while the last frames are decoded, unless keyframe propagation still has to run.
+        output_writer = None
+        if keyframe_config is None and config["data"].get("incremental_output", True):
+            output_writer = IncrementalVideoWriter(output_folder, config["data"]["fps"], cache_manager=cache_manager, frame_map=frame_map)
         if self.in_streamlit: st.markdown("Synthesizing videos ...")
         output_video = self.synthesize_video(model_manager, pipe, config["pipeline"]["seed"], smoother,
+                                             cache_manager=cache_manager, output_writer=output_writer,
                                              **config["pipeline"]["pipeline_inputs"])
+        if keyframe_config is not None:
+            output_video = self.propagate_keyframes(keyframe_config, guide_frames, output_video, keyframe_ids, output_folder, cache_manager=cache_manager)
+        if frame_map is not None:
+            output_video = [output_video[i] for i in frame_map]
         if self.in_streamlit: st.markdown("Synthesizing videos ... done!")
         if self.in_streamlit: st.markdown("Saving videos ...")
-        self.save_output(output_video, config["data"]["output_folder"], config["data"]["fps"], config)
+        self.save_output(output_video, config["data"]["output_folder"], config["data"]["fps"], config, cache_manager=cache_manager, output_writer=output_writer)
+        if writer is not None:
+            writer.close()
         if self.in_streamlit: st.markdown("Saving videos ... done!")
         if self.in_streamlit: st.markdown("Finished!")
         # video_file = open(os.path.join(os.path.join(config["data"]["output_folder"], "video.mp4")), 'rb')
@@ -1,4 +1,5 @@
 from ..models import ModelManager, SDXLTextEncoder, SDXLTextEncoder2, SDXLUNet, SDXLVAEDecoder, SDXLVAEEncoder, SDXLMotionModel
+from ..models.attention import mark_kv_cacheable, clear_kv_cache
 from .dancer import lets_dance_xl
 # TODO: SDXL ControlNet
 from ..prompts import SDXLPrompter
@@ -152,6 +153,11 @@ class SDXLVideoPipeline(torch.nn.Module):
                 positive=False,
             )
 
+        # The cross-attention K/V of the prompts are computed once per layer and reused in every step.
+        mark_kv_cacheable(prompt_emb_posi)
+        if cfg_scale != 1.0:
+            mark_kv_cacheable(prompt_emb_nega)
+
         # Prepare positional id
         add_time_id = torch.tensor([height, width, 0, 0, height, width], device=self.device)
         
@@ -184,6 +190,8 @@ class SDXLVideoPipeline(torch.nn.Module):
             if progress_bar_st is not None:
                 progress_bar_st.progress(progress_id / len(self.scheduler.timesteps))
         
+        clear_kv_cache(self.unet)
+
         # Decode image
         image = self.decode_images(latents.to(torch.float32))
 
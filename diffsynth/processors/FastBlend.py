@@ -7,6 +7,7 @@ from PIL import Image
 from tqdm import tqdm
 
 from .base import VideoProcessor
+from ..data.video import save_frame, load_frame_array
 from ..extensions.FastBlend.patch_match import PyramidPatchMatcher
 from ..extensions.FastBlend.runners.fast import TableManager
 
@@ -16,8 +17,10 @@ class FastBlendSmoother(VideoProcessor):
             self,
             output_folder="",
             inference_mode="fast", batch_size=8, window_size=60,
-            minimum_patch_size=5, threads_per_block=8, num_iter=5, gpu_id=0, guide_weight=10.0, initialize="identity", tracking_window_size=0
+            minimum_patch_size=5, threads_per_block=8, num_iter=5, gpu_id=0, guide_weight=10.0, initialize="identity", tracking_window_size=0,
+            cache_manager=None
     ):
+        self.cache_manager = cache_manager
         self.cache_folder = os.path.join(output_folder, "smoother")
         os.makedirs(self.cache_folder, exist_ok=True)
         self.cache_folder_left = os.path.join(self.cache_folder, "left")
@@ -25,6 +28,7 @@ class FastBlendSmoother(VideoProcessor):
         self.cache_folder_right = os.path.join(self.cache_folder, "right")
         os.makedirs(self.cache_folder_right, exist_ok=True)
         self.inference_mode = inference_mode
+        self.result_extension = ".png"
         self.batch_size = batch_size
         self.window_size = window_size
         self.ebsynth_config = {
@@ -42,10 +46,30 @@ class FastBlendSmoother(VideoProcessor):
         # TODO: fetch GPU ID from model_manager
         return FastBlendSmoother(output_folder=output_folder, **kwargs)
 
+    def load_image(self, frame):
+        path = frame.tolist() if isinstance(frame, np.ndarray) else frame
+        if self.cache_manager is not None:
+            return self.cache_manager.load(path, load_frame_array)
+        return load_frame_array(path)
+
+    def save_result(self, frame, path):
+        # The results are written in the same format as the rendered frames.
+        path = os.path.splitext(path)[0] + self.result_extension
+        image = frame.clip(0, 255).astype("uint8")
+        if self.cache_manager is not None:
+            self.cache_manager.write("smoother", path, save_frame, image)
+        else:
+            save_frame(path, image)
+        return path
+
+    def should_release_tables(self):
+        # Only clean up the intermediate tables if the user asked for a budget, otherwise keep them for inspection.
+        return self.cache_manager is not None and self.cache_manager.budgets.get("smoother") is not None
+
     def inference_fast(self, frames_guide, frames_style):
-        table_manager = TableManager()
+        table_manager = TableManager(cache_manager=self.cache_manager)
 
-        first_image = Image.open(frames_guide[0].tolist())
+        first_image = Image.fromarray(self.load_image(frames_guide[0]))
         patch_match_engine = PyramidPatchMatcher(
             image_height=first_image.height,
             image_width=first_image.width,
@@ -60,27 +84,26 @@ class FastBlendSmoother(VideoProcessor):
         table_r = table_manager.build_remapping_table(self.cache_folder_right, frames_guide[::-1], frames_style[::-1], patch_match_engine, self.batch_size, desc="Fast Mode Step 3/4")
         table_r = table_manager.remapping_table_to_blending_table(self.cache_folder_right, table_r)
         table_r = table_manager.process_window_sum(self.cache_folder_right, frames_guide[::-1], table_r, patch_match_engine, self.window_size, self.batch_size, desc="Fast Mode Step 4/4")[::-1]
-        # merge
-        frames = []
+        # merge, the frames are yielded one by one so that the next stage can start
         index = 0
         for (frame_l, weight_l), frame_m, (frame_r, weight_r) in zip(table_l, frames_style, table_r):
             if isinstance(frame_l, str):
-                frame_l = numpy.load(frame_l)
+                frame_l = table_manager.load_table(frame_l)
             if isinstance(frame_r, str):
-                frame_r = numpy.load(frame_r)
+                frame_r = table_manager.load_table(frame_r)
             weight_m = -1
             weight = weight_l + weight_m + weight_r
-            frame = frame_l * (weight_l / weight) + np.array(Image.open(frame_m.tolist())) * (weight_m / weight) + frame_r * (weight_r / weight)
+            frame = frame_l * (weight_l / weight) + self.load_image(frame_m) * (weight_m / weight) + frame_r * (weight_r / weight)
             path = os.path.join(self.cache_folder, f"{index}.png")
-            Image.fromarray(frame.clip(0, 255).astype("uint8")).save(path)
-            frames.append(path)
+            yield self.save_result(frame, path)
             index += 1
+        if self.should_release_tables():
+            table_manager.release_tables()
         # frames = [frame.clip(0, 255).astype("uint8") for frame in frames]
         # frames = [Image.fromarray(frame) for frame in frames]
-        return frames
 
     def inference_balanced(self, frames_guide, frames_style):
-        first_image = Image.open(frames_style[0].tolist())
+        first_image = Image.fromarray(self.load_image(frames_style[0]))
         patch_match_engine = PyramidPatchMatcher(
             image_height=first_image.height,
             image_width=first_image.width,
@@ -100,9 +123,9 @@ class FastBlendSmoother(VideoProcessor):
         frames = [(None, 1) for i in range(n)]
         for batch_id in tqdm(range(0, len(tasks), self.batch_size), desc="Balanced Mode"):
             tasks_batch = tasks[batch_id: min(batch_id + self.batch_size, len(tasks))]
-            source_guide = np.stack([np.array(Image.open(frames_guide[source].tolist())) for source, target in tasks_batch])
-            target_guide = np.stack([np.array(Image.open(frames_guide[target].tolist())) for source, target in tasks_batch])
-            source_style = np.stack([np.array(Image.open(frames_style[source].tolist())) for source, target in tasks_batch])
+            source_guide = np.stack([self.load_image(frames_guide[source]) for source, target in tasks_batch])
+            target_guide = np.stack([self.load_image(frames_guide[target]) for source, target in tasks_batch])
+            source_style = np.stack([self.load_image(frames_style[source]) for source, target in tasks_batch])
             _, target_style = patch_match_engine.estimate_nnf(source_guide, target_guide, source_style)
             for (source, target), result in zip(tasks_batch, target_style):
                 frame, weight = frames[target]
@@ -118,44 +141,50 @@ class FastBlendSmoother(VideoProcessor):
                     weight + 1
                 )
                 if weight + 1 == min(n, target + self.window_size + 1) - max(0, target - self.window_size):
-                    frame = frame.clip(0, 255).astype("uint8")
                     path = os.path.join(self.cache_folder, f"{index}.png")
-                    Image.fromarray(frame).save(path)
-                    output_frames.append(path)
+                    output_frames.append(self.save_result(frame, path))
                     frames[target] = (None, 1)
                     index += 1
         return output_frames
 
     def inference_accurate(self, frames_guide, frames_style):
-        global patch_match_engine
-        first_image = Image.open(frames_style[0].tolist())
-        patch_match_engine = PyramidPatchMatcher(
-            image_height=first_image.height,
-            image_width=first_image.width,
-            channel=3,
-            use_mean_target_style=True,
-            **self.ebsynth_config
-        )
-        output_frames = []
-        index = 0
-        # run
-        n = len(frames_style)
-        for target in tqdm(range(n), desc="Accurate Mode"):
-            l, r = max(target - self.window_size, 0), min(target + self.window_size + 1, n)
-            remapped_frames = []
-            for i in range(l, r, self.batch_size):
-                j = min(i + self.batch_size, r)
-                source_guide = np.stack([np.array(Image.open(frames_guide[source].tolist())) for source in range(i, j)])
-                target_guide = np.stack([np.array(Image.open(frames_guide[target].tolist()))] * (j - i))
-                source_style = np.stack([np.array(Image.open(frames_style[source].tolist())) for source in range(i, j)])
-                _, target_style = patch_match_engine.estimate_nnf(source_guide, target_guide, source_style)
-                remapped_frames.append(target_style)
-            frame = np.concatenate(remapped_frames, axis=0).mean(axis=0)
-            path = os.path.join(self.cache_folder, f"{index}.png")
-            Image.fromarray(frame.clip(0, 255).astype("uint8")).save(path)
-            output_frames.append(path)
-            index += 1
-        return output_frames
+        # frames_style can be an iterator, frame t is blended as soon as frame t + window_size has arrived.
+        patch_match_engine = None
+        received_frames = []
+        n = len(frames_guide)
+        progress_bar = tqdm(total=n, desc="Accurate Mode")
+        target = 0
+        for frame in frames_style:
+            received_frames.append(frame)
+            if patch_match_engine is None:
+                first_image = Image.fromarray(self.load_image(frame))
+                patch_match_engine = PyramidPatchMatcher(
+                    image_height=first_image.height,
+                    image_width=first_image.width,
+                    channel=3,
+                    use_mean_target_style=True,
+                    **self.ebsynth_config
+                )
+            while target < n and len(received_frames) >= min(target + self.window_size + 1, n):
+                yield self.accurate_frame(patch_match_engine, frames_guide, received_frames, target)
+                progress_bar.update(1)
+                target += 1
+        progress_bar.close()
+
+    def accurate_frame(self, patch_match_engine, frames_guide, frames_style, target):
+        n = len(frames_guide)
+        l, r = max(target - self.window_size, 0), min(target + self.window_size + 1, n)
+        remapped_frames = []
+        for i in range(l, r, self.batch_size):
+            j = min(i + self.batch_size, r)
+            source_guide = np.stack([self.load_image(frames_guide[source]) for source in range(i, j)])
+            target_guide = np.stack([self.load_image(frames_guide[target])] * (j - i))
+            source_style = np.stack([self.load_image(frames_style[source]) for source in range(i, j)])
+            _, target_style = patch_match_engine.estimate_nnf(source_guide, target_guide, source_style)
+            remapped_frames.append(target_style)
+        frame = np.concatenate(remapped_frames, axis=0).mean(axis=0)
+        path = os.path.join(self.cache_folder, f"{target}.png")
+        return self.save_result(frame, path)
 
     def release_vram(self):
         mempool = cp.get_default_memory_pool()
@@ -164,15 +193,35 @@ class FastBlendSmoother(VideoProcessor):
         pinned_mempool.free_all_blocks()
 
     def __call__(self, rendered_frames, original_frames=None, **kwargs):
+        if isinstance(rendered_frames[0], str):
+            self.result_extension = os.path.splitext(rendered_frames[0])[1]
         rendered_frames = [np.array(frame) for frame in rendered_frames]
         original_frames = [np.array(frame) for frame in original_frames]
         if self.inference_mode == "fast":
-            output_frames = self.inference_fast(original_frames, rendered_frames)
+            output_frames = list(self.inference_fast(original_frames, rendered_frames))
         elif self.inference_mode == "balanced":
             output_frames = self.inference_balanced(original_frames, rendered_frames)
         elif self.inference_mode == "accurate":
-            output_frames = self.inference_accurate(original_frames, rendered_frames)
+            output_frames = list(self.inference_accurate(original_frames, rendered_frames))
         else:
             raise ValueError("inference_mode must be fast, balanced or accurate")
         self.release_vram()
         return output_frames
+
+    def stream(self, rendered_frames, original_frames=None, **kwargs):
+        # accurate: frames are blended while the rest of the video is still being decoded.
+        # fast: the tables need the whole video, but the merged frames are passed on one by one.
+        if self.inference_mode not in ["fast", "accurate"]:
+            yield from self(list(rendered_frames), original_frames=original_frames, **kwargs)
+            return
+        def remember_extension(frames):
+            for frame in frames:
+                if isinstance(frame, str):
+                    self.result_extension = os.path.splitext(frame)[1]
+                yield frame
+        rendered_frames = remember_extension(rendered_frames)
+        if self.inference_mode == "fast":
+            yield from self.inference_fast(original_frames, list(rendered_frames))
+        else:
+            yield from self.inference_accurate(original_frames, rendered_frames)
+        self.release_vram()
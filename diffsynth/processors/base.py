@@ -1,6 +1,25 @@
+from PIL import Image
+
+from ..data.video import load_frame, load_frame_array
+
+
 class VideoProcessor:
     def __init__(self):
         pass
 
     def __call__(self):
         raise NotImplementedError
+
+    def stream(self, rendered_frames, cache_manager=None, **kwargs):
+        # rendered_frames is an iterator, the processed frames are yielded in order as soon as they are ready.
+        # Processors that need the whole video collect it first. Frame files may still be written in the background,
+        # they are read through cache_manager (which waits for them) and passed to __call__ as images.
+        frames = [self.load_frame(frame, cache_manager) for frame in rendered_frames]
+        yield from self(frames, **kwargs)
+
+    def load_frame(self, frame, cache_manager=None):
+        if not isinstance(frame, str):
+            return frame
+        if cache_manager is not None:
+            return Image.fromarray(cache_manager.load(frame, load_frame_array))
+        return load_frame(frame)
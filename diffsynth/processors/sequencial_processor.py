@@ -6,10 +6,10 @@ class AutoVideoProcessor(VideoProcessor):
         pass
 
     @staticmethod
-    def from_model_manager(model_manager, processor_type, output_folder, **kwargs):
+    def from_model_manager(model_manager, processor_type, output_folder, cache_manager=None, **kwargs):
         if processor_type == "FastBlend":
             from .FastBlend import FastBlendSmoother
-            return FastBlendSmoother.from_model_manager(model_manager, output_folder, **kwargs)
+            return FastBlendSmoother.from_model_manager(model_manager, output_folder, cache_manager=cache_manager, **kwargs)
         elif processor_type == "Contrast":
             from .PILEditor import ContrastEditor
             return ContrastEditor.from_model_manager(model_manager, **kwargs)
@@ -28,9 +28,9 @@ class SequencialProcessor(VideoProcessor):
         self.processors = processors
 
     @staticmethod
-    def from_model_manager(model_manager, output_folder, configs):
+    def from_model_manager(model_manager, output_folder, configs, cache_manager=None):
         processors = [
-            AutoVideoProcessor.from_model_manager(model_manager, config["processor_type"], output_folder, **config["config"])
+            AutoVideoProcessor.from_model_manager(model_manager, config["processor_type"], output_folder, cache_manager=cache_manager, **config["config"])
             for config in configs
         ]
         return SequencialProcessor(processors)
@@ -39,3 +39,8 @@ class SequencialProcessor(VideoProcessor):
         for processor in self.processors:
             rendered_frames = processor(rendered_frames, **kwargs)
         return rendered_frames
+
+    def stream(self, rendered_frames, **kwargs):
+        for processor in self.processors:
+            rendered_frames = processor.stream(rendered_frames, **kwargs)
+        yield from rendered_frames
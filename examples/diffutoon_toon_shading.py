@@ -90,5 +90,6 @@ config = {
     }
 }
 
-runner = SDVideoPipelineRunner()
-runner.run(config)
+if __name__ == "__main__":
+    runner = SDVideoPipelineRunner()
+    runner.run(config)
@@ -0,0 +1,53 @@
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from diffsynth.data.video import save_frame, load_frame_array, frame_file_name, frame_formats, search_for_images
+
+# Compare the intermediate frame formats (config.data.frame_format).
+# Usage: python examples/frame_format_benchmark.py [image_folder]
+# Without an image folder, synthetic 1024x576 frames are used.
+
+
+def synthetic_frames(num_frames=16, height=576, width=1024):
+    y, x = np.mgrid[0:height, 0:width]
+    frames = []
+    for i in range(num_frames):
+        frame = np.stack([(x + i * 8) % 256, (y + i * 4) % 256, (x + y) % 256], axis=-1)
+        frame = frame + np.random.randint(0, 8, frame.shape)
+        frames.append(frame.clip(0, 255).astype(np.uint8))
+    return frames
+
+
+def benchmark(frames, frame_format, folder):
+    paths = [os.path.join(folder, frame_file_name(i, frame_format)) for i in range(len(frames))]
+    start = time.time()
+    for path, frame in zip(paths, frames):
+        save_frame(path, frame)
+    encode_time = (time.time() - start) / len(frames)
+    start = time.time()
+    for path, frame in zip(paths, frames):
+        assert (load_frame_array(path) == frame).all()
+    decode_time = (time.time() - start) / len(frames)
+    size = sum(os.path.getsize(path) for path in paths) / len(frames)
+    return encode_time, decode_time, size
+
+
+if len(sys.argv) > 1:
+    frames = [load_frame_array(path) for path in search_for_images(sys.argv[1])[:16]]
+else:
+    frames = synthetic_frames()
+
+print(f"{len(frames)} frames, {frames[0].shape[1]}x{frames[0].shape[0]}")
+print(f"{'format':<8}{'encode ms/frame':>18}{'decode ms/frame':>18}{'MiB/frame':>12}")
+for frame_format in frame_formats:
+    with tempfile.TemporaryDirectory() as folder:
+        try:
+            encode_time, decode_time, size = benchmark(frames, frame_format, folder)
+        except ImportError as e:
+            print(f"{frame_format:<8}skipped ({e})")
+            continue
+    print(f"{frame_format:<8}{encode_time * 1000:>18.2f}{decode_time * 1000:>18.2f}{size / (1 << 20):>12.2f}")
@@ -0,0 +1,30 @@
+import torch
+
+from diffsynth.models.offload import ActivationOffloader, OffloadedTensor
+
+
+# On CPU nothing is copied, but the bookkeeping is the same as with CUDA.
+
+
+def test_activation_offload_round_trip():
+    offloader = ActivationOffloader("cpu")
+    tensors = [torch.randn((2, 4, 8, 8)) for _ in range(3)]
+    offloaded = [offloader.offload(tensor.clone()) for tensor in tensors]
+    assert all(isinstance(item, OffloadedTensor) for item in offloaded)
+    # The last residual is needed first, it is prefetched while other blocks run.
+    offloader.prefetch(offloaded[-1])
+    offloader.prefetch(offloaded[-1])
+    restored = [offloader.fetch(item) for item in reversed(offloaded)][::-1]
+    for tensor, restored_tensor in zip(tensors, restored):
+        assert torch.equal(tensor, restored_tensor)
+    assert offloader.num_offloaded == 3
+    assert offloader.num_prefetched == 3
+    assert offloader.num_fetched == 3
+
+
+def test_activation_offload_passes_plain_tensors():
+    offloader = ActivationOffloader("cpu")
+    tensor = torch.randn((1, 4))
+    assert offloader.fetch(tensor) is tensor
+    offloader.prefetch(tensor)
+    assert offloader.num_prefetched == 0
@@ -0,0 +1,27 @@
+import os
+
+import numpy as np
+import torch
+
+from diffsynth.data.checkpoint import LatentCheckpoint
+
+
+def test_partial_files_removed_after_step(tmp_path):
+    checkpoint = LatentCheckpoint(str(tmp_path))
+    accumulator_path = os.path.join(tmp_path, "accumulator.bin")
+    np.arange(8, dtype=np.float32).tofile(accumulator_path)
+
+    checkpoint.save_partial(3, "key", window_id=0, accumulator_file=accumulator_path, weights=torch.ones(2))
+    first_copy = checkpoint.load_partial(3, "key")["accumulator_path"]
+    checkpoint.save_partial(3, "key", window_id=1, accumulator_file=accumulator_path, weights=torch.ones(2))
+    second_copy = checkpoint.load_partial(3, "key")["accumulator_path"]
+    # The copy of the previous partial checkpoint is replaced, not overwritten in place
+    assert second_copy != first_copy
+    assert os.path.exists(second_copy) and not os.path.exists(first_copy)
+    assert np.array_equal(np.fromfile(second_copy, dtype=np.float32), np.arange(8, dtype=np.float32))
+
+    checkpoint.save(3, torch.zeros((2, 4, 8, 8)))
+    assert checkpoint.load_partial(3, "key") is None
+    assert not os.path.exists(checkpoint.partial_path)
+    assert not os.path.exists(second_copy)
+    assert checkpoint.load()["progress_id"] == 3
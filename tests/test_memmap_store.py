@@ -0,0 +1,50 @@
+import os
+
+import pytest
+import torch
+
+from diffsynth.data.cache import MemmapTensorStore
+
+
+# Every dtype MemmapTensorStore supports, including bfloat16 (stored as int16).
+@pytest.mark.parametrize("dtype", list(MemmapTensorStore.dtype_dict))
+def test_round_trip(tmp_path, dtype):
+    path = os.path.join(tmp_path, "store.bin")
+    frames = (torch.rand((4, 3, 8, 8)) * 255).to(dtype)
+    store = MemmapTensorStore(path, len(frames), frames.shape[1:], dtype=dtype)
+    for index, frame in enumerate(frames):
+        store[index] = frame
+    store.flush()
+
+    reopened = MemmapTensorStore(path, len(frames), frames.shape[1:], dtype=dtype)
+    assert reopened.missing_frames() == []
+    assert reopened[0: len(frames)].dtype == dtype
+    assert torch.equal(reopened[0: len(frames)], frames)
+    reopened.load_to_memory()
+    assert torch.equal(reopened[1], frames[1])
+
+
+def test_remap_after_resize(tmp_path):
+    path = os.path.join(tmp_path, "store.bin")
+    frames = torch.rand((4, 3, 8, 8)).to(torch.float16)
+    store = MemmapTensorStore(path, 4, frames.shape[1:])
+    for index in [0, 1, 3]:
+        store[index] = frames[index]
+    store.flush()
+    del store
+
+    # Two frames more, frame 1 moves to 0, frame 3 to 5, frame 2 was never written
+    resized = MemmapTensorStore(path, 6, frames.shape[1:])
+    assert resized.previous_frames == 4
+    assert resized.missing_frames() == list(range(6))
+    copied = resized.remap([1, None, 2, None, None, 3])
+    assert copied == [0, 5]
+    assert torch.equal(resized[0], frames[1])
+    assert torch.equal(resized[5], frames[3])
+    assert resized.missing_frames() == [1, 2, 3, 4]
+    assert not os.path.exists(path + ".previous")
+    assert not os.path.exists(path + ".done.previous")
+
+    reopened = MemmapTensorStore(path, 6, frames.shape[1:])
+    assert reopened.previous is None
+    assert torch.equal(reopened[5], frames[3])
@@ -0,0 +1,54 @@
+import pytest
+import torch
+
+from diffsynth.models.attention import Attention
+from diffsynth.pipelines.dancer import clip_batches, select_text_emb
+
+
+def expected_rows(text_emb, num_frames, start, end):
+    # One row per frame, the reference select_text_emb is compared with
+    return text_emb.repeat_interleave(num_frames // text_emb.shape[0], dim=0)[start: end]
+
+
+def broadcast(text_emb, batch_size):
+    # What Attention.torch_forward does with fewer encoder states than rows
+    return text_emb.repeat_interleave(batch_size // text_emb.shape[0], dim=0)
+
+
+@pytest.mark.parametrize("num_segments", [1, 2, 4, 16])
+@pytest.mark.parametrize("batch_size", [1, 3, 16])
+def test_select_per_segment(num_segments, batch_size):
+    num_frames = 16
+    positive, negative = torch.randn((num_segments, 5, 8)), torch.randn((num_segments, 5, 8))
+    for clip_start, batch_id, batch_id_ in clip_batches(2 * num_frames, num_frames, batch_size):
+        text_emb = select_text_emb([positive, negative], num_frames, clip_start, batch_id, batch_id_)
+        rows = batch_id_ - batch_id
+        assert rows % text_emb.shape[0] == 0
+        reference = positive if clip_start == 0 else negative
+        assert torch.equal(broadcast(text_emb, rows), expected_rows(reference, num_frames, batch_id - clip_start, batch_id_ - clip_start))
+
+
+def test_select_per_row_of_sample():
+    num_frames = 4
+    text_emb = torch.randn((2 * num_frames, 5, 8))
+    for clip_start, batch_id, batch_id_ in clip_batches(2 * num_frames, num_frames, 3):
+        assert torch.equal(select_text_emb(text_emb, num_frames, clip_start, batch_id, batch_id_), text_emb[batch_id: batch_id_])
+
+
+def test_uneven_segments():
+    with pytest.raises(ValueError):
+        select_text_emb(torch.randn((3, 5, 8)), 16, 0, 0, 4)
+
+
+def test_attention_with_per_frame_prompt():
+    # Materialized per-frame prompts with a UNet batch smaller than the window
+    torch.manual_seed(0)
+    num_frames = 16
+    attention = Attention(q_dim=8, num_heads=2, head_dim=4, kv_dim=8)
+    hidden_states = torch.randn((num_frames, 6, 8))
+    text_emb = torch.randn((1, 5, 8)).repeat(num_frames, 1, 1)
+    full = attention(hidden_states, text_emb)
+    for clip_start, batch_id, batch_id_ in clip_batches(num_frames, num_frames, 1):
+        output = attention(hidden_states[batch_id: batch_id_], select_text_emb(text_emb, num_frames, clip_start, batch_id, batch_id_))
+        assert output.shape == (1, 6, 8)
+        assert torch.allclose(output, full[batch_id: batch_id_], atol=1e-5)
@@ -0,0 +1,62 @@
+import copy
+
+import torch
+
+from diffsynth.models.offload import WeightStreamer
+
+
+# On CPU the "device" copies are a separate tensor pool, the bookkeeping is the same as with CUDA.
+
+
+def make_model():
+    torch.manual_seed(0)
+    return torch.nn.Sequential(
+        torch.nn.Linear(16, 32),
+        torch.nn.LayerNorm(32),
+        torch.nn.Linear(32, 64),
+        torch.nn.Linear(64, 8),
+    )
+
+
+def test_streamed_forward_matches():
+    model = make_model()
+    reference = copy.deepcopy(model)
+    x = torch.randn((4, 16))
+    with torch.no_grad():
+        expected = reference(x)
+
+    streamer = WeightStreamer("cpu")
+    units = list(model)
+    streamer.attach(model, units)
+    host_weights = [unit.weight.data for unit in units]
+    hidden_states = x
+    with torch.no_grad():
+        for unit_id, unit in enumerate(units):
+            streamer.load(unit)
+            if unit_id + 1 < len(units):
+                streamer.prefetch(units[unit_id + 1])
+            hidden_states = unit(hidden_states)
+            streamer.evict(unit)
+    assert torch.allclose(hidden_states, expected)
+
+    # Only one unit was resident at a time, and the host weights are back in place.
+    unit_bytes = [sum(p.numel() * p.element_size() for p in unit.parameters()) for unit in units]
+    assert streamer.resident_bytes == 0
+    assert streamer.peak_resident_bytes == max(unit_bytes)
+    for unit, host_weight, reference_unit in zip(units, host_weights, reference):
+        assert unit.weight.data_ptr() == host_weight.data_ptr()
+        assert torch.equal(unit.weight, reference_unit.weight)
+
+
+def test_streamed_weights_are_not_modified_in_place():
+    model = make_model()
+    streamer = WeightStreamer("cpu")
+    streamer.attach(model, list(model))
+    unit = model[0]
+    host_weight = unit.weight.data
+    streamer.load(unit)
+    assert unit.weight.data_ptr() != host_weight.data_ptr()
+    unit.weight.data.zero_()
+    streamer.evict(unit)
+    assert unit.weight.data_ptr() == host_weight.data_ptr()
+    assert host_weight.abs().sum() > 0